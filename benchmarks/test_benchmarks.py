@@ -0,0 +1,105 @@
+"""
+Performance baselines for the simulator and assembler hot paths
+
+Not part of the default test run, run them with
+
+    python -m pytest benchmarks --benchmark-json=bench_output.json
+
+or save and compare runs with --benchmark-autosave and --benchmark-compare.
+Rates such as T-states per round are stored in extra_info.
+"""
+
+import itertools
+
+import pytest # type: ignore
+
+pytest.importorskip("pytest_benchmark")
+
+from sapy.components import Computer
+from sapy.assembler import assemble_lines, AssemblerSession
+
+countdown = [
+    0x20, 0xFF, # 0x00 LDA #$FF
+    0x22, 0x01, # 0x02 SUB #$01
+    0x38, 0x02, # 0x04 BNZ $02
+    0xFF,       # 0x06 HLT
+    ]
+
+@pytest.mark.parametrize("compiled", [False, True], ids=['clock', 'compiled_clock'])
+def test_clock_step(benchmark, compiled):
+    cpu = Computer(compiled=compiled)
+    cpu.switches.load_program([0xFE] * 256)
+    t_states = 1000
+
+    def steps():
+        for _ in range(t_states):
+            cpu.step(debug=False)
+
+    benchmark(steps)
+    benchmark.extra_info['t_states'] = t_states
+
+@pytest.mark.parametrize("mode", ['microcode', 'instruction', 'jit'])
+def test_countdown_loop(benchmark, mode):
+    def run():
+        cpu = Computer()
+        cpu.switches.load_program(countdown)
+        return cpu.run(mode=mode)
+
+    result = benchmark(run)
+    assert result.halt_reason == 'halted'
+    benchmark.extra_info['instructions'] = result.instructions
+    benchmark.extra_info['t_states'] = result.cycles
+
+def test_computer_construction(benchmark):
+    benchmark(Computer)
+
+def test_computer_reset(benchmark):
+    cpu = Computer()
+    benchmark(cpu.reset)
+
+def test_computer_reset_after_run(benchmark):
+    # running may leave caches watching memory
+    cpu = Computer()
+    cpu.switches.load_program(countdown)
+    cpu.run()
+    benchmark(cpu.reset)
+
+def test_computer_restore_after_run(benchmark):
+    cpu = Computer()
+    cpu.switches.load_program(countdown)
+    snapshot = cpu.snapshot()
+    cpu.run()
+    benchmark(cpu.restore, snapshot)
+
+def test_dma_read_ram(benchmark):
+    cpu = Computer()
+    cpu.switches.load_program(countdown)
+    benchmark(cpu.dma.read_ram)
+
+def generated_source(lines, labels=40):
+    # labels must stay inside the 256 bytes of RAM
+    source = []
+    for i in range(lines // 4):
+        if i < labels:
+            source.append(f"label{i:03}:")
+        source.append(f"    LDA #${i % 0x100:02X}")
+        source.append(f"    ADD ${(i * 7) % 0x100:02X}  ; comment")
+        source.append(f"    BNZ label{i % labels:03}")
+    return '\n'.join(source)
+
+@pytest.mark.parametrize("lines", [100, 1000])
+def test_assemble(benchmark, lines):
+    source = generated_source(lines).splitlines()
+    benchmark(assemble_lines, source)
+    benchmark.extra_info['lines'] = lines
+
+def test_session_edit(benchmark):
+    # one keystroke changing a line in the middle of the source
+    source = generated_source(1000).splitlines()
+    edited = list(source)
+    edited[len(source) // 2] = "    LDA #$42"
+    session = AssemblerSession(source)
+    versions = itertools.cycle([edited, source])
+
+    benchmark(lambda: session.update(next(versions)))
+    benchmark.extra_info['lines'] = len(source)
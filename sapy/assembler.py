@@ -1,129 +1,441 @@
-from typing import List, Dict
+import functools
+import itertools
+import re
+
+from dataclasses import dataclass
+from typing import List, Dict, Optional
 
 from sapy.components import opcode_map, mnemonics, implied, absolute, absolute_branching, indirect, indirect_branching, immediate
 
 
 MNEMONIC = {m.mnemonic:m for m in mnemonics}
 
+@dataclass
+class ListingLine:
+    address: int
+    bytecode: List[int]
+    source: str
+    # label defined at address, '' for none
+    label: str
+
 def assemble(assembly_text):
-    instructions, labels = preprocess(assembly_text)
-    bytecode = translate_instructions(instructions, labels)
+    """Assemble source text, printing a listing"""
+    bytecode, listing = assemble_lines(assembly_text.split('\n'), listing=True)
+    for line in listing:
+        print(format_listing_line(line))
     return bytecode
 
-def translate_instructions(instructions, labels):
+def assemble_lines(lines, listing=False):
+    """
+    Assemble an iterable of source lines, such as an open file, without printing
+
+    Macros are expanded first, then each line is translated once. Operands
+    naming a label or constant get a placeholder that link() fills in.
+    Returns the bytecode, or (bytecode, listing) with a ListingLine for
+    each instruction when listing is true.
+    """
+    translated = [translate_line(line) for line in expand_macros(lines)]
+    bytecode, labels, constants = link(translated)
+    if not listing:
+        return bytecode
+
+    labels_lookup = {address: label for label, address in labels.items()}
+    listing_lines = []
+    address = 0x00
+    for line in translated:
+        if line.bytecode:
+            end = address + len(line.bytecode)
+            listing_lines.append(ListingLine(address, bytecode[address:end], line.source, labels_lookup.get(address, '')))
+            address = end
+    return bytecode, listing_lines
+
+def link(translated):
+    """
+    Bytecode of TranslatedLines with operand expressions filled in, the
+    address of each label and the value of each constant
+
+    A constant may use any label, and the constants defined above it.
+    """
+    labels = dict()
+    constants = dict()
+    address = 0x00
+    for line in translated:
+        name = line.label if line.constant is None else line.constant
+        if name is not None:
+            if name in labels or name in constants:
+                raise RuntimeError(f"Symbol \"{name}\" is defined more than once")
+            if line.constant is None:
+                labels[name] = address
+            else:
+                constants[name] = None
+        address += len(line.bytecode)
+
+    symbols = dict(labels)
+    for line in translated:
+        if line.constant is not None:
+            symbols[line.constant] = evaluate(line.operand, symbols)
+    constants = {name: symbols[name] for name in constants}
+
     bytecode = []
-    byte_location = 0x00
-    for i in instructions:
-        try:
-            labelname = ':' + labels[byte_location]
-        except KeyError:
-            # no label
-            labelname = ""
+    for line in translated:
+        if line.operand is None:
+            bytecode.extend(line.bytecode)
+        elif line.constant is None:
+            # most operands name a single label
+            value = symbols.get(line.operand)
+            if value is None:
+                value = evaluate(line.operand, symbols)
+            bytecode.append(line.bytecode[0])
+            bytecode.append(operand_byte(value, line.operand))
+    return bytecode, labels, constants
 
-        new_bytes = translate_instruction(i)
-        bytecode.extend(new_bytes)
-        hexdump = ' '.join([f"{new_byte:02X}" for new_byte in new_bytes])
+def diff_bytecode(old, new):
+    """
+    (address, bytes) runs that turn old bytecode into new, bytes new no
+    longer covers are cleared as in a freshly loaded memory
+    """
+    new = list(new) + [0x00] * (len(old) - len(new))
+    patch = []
+    for address, (before, after) in enumerate(itertools.zip_longest(old, new)):
+        if before == after:
+            continue
+        if patch and patch[-1][0] + len(patch[-1][1]) == address:
+            patch[-1][1].append(after)
+        else:
+            patch.append((address, [after]))
+    return [(address, bytes(data)) for address, data in patch]
 
-        print(f"0x{byte_location:02X}  {hexdump:8}# {i:10}{labelname}")
-        byte_location += len(new_bytes)
+class AssemblerSession():
+    """
+    Assembles a source that is edited line by line
 
-    return bytecode
+    The translation of every line is kept, so an edit only translates the
+    lines it changes before linking addresses and labels again. While the
+    source defines macros, an edit to a definition can change any line
+    using it, so every edit translates the whole expanded source. Each edit
+    returns a patch of (address, bytes) runs turning the previous bytecode
+    into the new one, for SwitchBoard.load_patch.
+    """
+    def __init__(self, lines=()):
+        self.lines = []
+        self.bytecode = []
+        self.labels = dict()
+        self.constants = dict()
+        # translation of each source line, None while macros are defined
+        self._translated = []
+        self._macro_definitions = 0
+        self.edit(0, 0, lines)
 
-def translate_instruction(instruction):
+    def edit(self, start, stop, lines):
+        """Replace source lines start to stop with lines, returns the patch"""
+        lines = list(lines)
+        source = self.lines[:start] + lines + self.lines[stop:]
+        macro_definitions = (self._macro_definitions
+            - sum(map(defines_macro, self.lines[start:stop])) + sum(map(defines_macro, lines)))
+        if macro_definitions:
+            translated = None
+            bytecode, labels, constants = link([translate_line(line) for line in expand_macros(source)])
+        else:
+            if self._translated is None:
+                # nothing left to expand, translate every line once more
+                translated = [translate_line(line) for line in expand_macros(source)]
+            else:
+                # without definitions each line expands to itself, or raises
+                translated = self._translated[:start] + [translate_line(line) for line in expand_macros(lines)] + self._translated[stop:]
+            bytecode, labels, constants = link(translated)
+        patch = diff_bytecode(self.bytecode, bytecode)
 
-    # split on one or more whitespace chars
-    split_instruction = instruction.split(None, 1)
+        # only keep the edit once it assembled
+        self.lines = source
+        self._translated = translated
+        self._macro_definitions = macro_definitions
+        self.bytecode = bytecode
+        self.labels = labels
+        self.constants = constants
+        return patch
 
-    if len(split_instruction) == 1:
-        # no arguments
-        arg_addressing_mode = implied
-        mne = MNEMONIC[instruction]
-        arg_list = []
-    else:
-        # must handle argument
-        mne_chars, arg = split_instruction
+    def update(self, lines):
+        """Replace the whole source, translating only the lines that changed"""
+        lines = list(lines)
+        old = self.lines
+        common = min(len(old), len(lines))
+        prefix = 0
+        while prefix < common and old[prefix] == lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < common - prefix and old[-1 - suffix] == lines[-1 - suffix]:
+            suffix += 1
+        return self.edit(prefix, len(old) - suffix, lines[prefix:len(lines) - suffix])
 
-        if mne_chars == 'BYTE':
-            assert arg[0] == '#', "BYTES must follow this syntax: \"BYTES #09 33 FA ...\""
-            arg = arg[1:]
-            arg_list = [int(byte, 16) for byte in arg.split()]
-            return arg_list
+@dataclass
+class TranslatedLine:
+    # label the line defines, None for other lines
+    label: Optional[str]
+    source: str
+    # empty for blank lines, comments, label and constant definitions
+    bytecode: List[int]
+    # expression naming symbols, its value belongs in bytecode[1], or is
+    # the value of the constant the line defines
+    operand: Optional[str]
+    # constant the line defines with EQU, None for other lines
+    constant: Optional[str] = None
 
-        mne = MNEMONIC[mne_chars]
+def translate_line(line):
+    """Translate a single source line, leaving a placeholder for an operand naming symbols"""
+    label, mnemonic, arg = tokenize(line)
+    if mnemonic is None:
+        return TranslatedLine(label, '', [], None)
 
-        # Should be one or the other
-        # This could only go wrong with misconfigured mnemonics
-        ads = mne.addressing_modes
-        assert not ((indirect in ads) and (indirect_branching in ads))
-        assert not ((absolute in ads) and (indirect_branching in ads))
-        assert not ((absolute_branching in ads) and (indirect in ads))
-        assert not ((absolute_branching in ads) and (absolute in ads))
-
-        data_addressing_modes = [immediate, absolute, indirect]
-        branching_addressing_modes = [absolute_branching, indirect_branching]
-
-        is_data_add_mode = any(ad in data_addressing_modes for ad in ads)
-        is_branching_add_mode = any(ad in branching_addressing_modes for ad in ads)
-
-        if is_data_add_mode and arg[0] == '$':
-                arg_addressing_mode = absolute
-                arg_list = [int(arg[1:], 16)]
-        elif is_data_add_mode and arg[0] == '#' and arg[1] == '$':
-                arg_list = [int(arg[2:], 16)]
-                arg_addressing_mode = immediate
-        elif is_data_add_mode and arg[0] == '(' and arg[1] == '$' and arg[-1] == ')':
-                arg_list = [int(arg[2:-1], 16)]
-                arg_addressing_mode = indirect
-        elif is_branching_add_mode and arg[0] == '$':
-            arg_addressing_mode = absolute_branching
-            arg_list = [int(arg[1:], 16)]
-        elif is_branching_add_mode and arg[0] == '(' and arg[1] == '$' and arg[-1] == ')':
-            arg_list = [int(arg[2:-1], 16)]
-            arg_addressing_mode = indirect_branching
+    source = mnemonic if arg is None else f"{mnemonic} {arg}"
+    if mnemonic == 'BYTE':
+        return TranslatedLine(None, source, translate_bytes(arg), None)
+
+    constant = constant_definition_pattern.fullmatch(source)
+    if constant:
+        return TranslatedLine(None, '', [], constant['expression'], constant['name'])
+
+    syntax, value, expression = parse_operand(arg)
+    if expression is not None:
+        value = 0x00
+    return TranslatedLine(None, source, encode_instruction(mnemonic, syntax, value), expression)
+
+### Macros ###
+MAX_MACRO_DEPTH = 16
+
+@dataclass
+class Macro:
+    parameters: List[str]
+    body: List[str]
+
+def defines_macro(line):
+    """True for the first line of a macro definition"""
+    return tokenize(line)[1] == 'MACRO'
+
+def expand_macros(lines):
+    """
+    Source lines with macro definitions removed and each use of a macro
+    replaced by its body
+
+        MACRO name first, second
+            ...
+        ENDM
+
+    defines a macro, the line "name x, y" uses it. In the body each
+    parameter is replaced by its argument and \\@ by a suffix unique to the
+    use, @1, @2 and so on, so labels such as "loop\\@:" can be defined in a
+    macro used twice. Only macros make symbols with @ in them.
+    Macros are defined before their first use and may use other macros.
+    """
+    macros = dict()
+    uses = itertools.count(1)
+    definition = None
+    for line in lines:
+        label, mnemonic, arg = tokenize(line)
+        if definition is not None:
+            if mnemonic == 'ENDM':
+                definition = None
+            else:
+                definition.body.append(line)
+        elif mnemonic in macros:
+            yield from _expand_macro(macros, uses, mnemonic, arg, 0)
+        elif mnemonic == 'MACRO':
+            definition = _define_macro(macros, arg)
+        elif mnemonic == 'ENDM':
+            raise RuntimeError("ENDM without MACRO")
+        elif '@' in line and '@' in line.split(';', 1)[0]:
+            raise RuntimeError(f"Only macros make symbols with @ in them, \"{line.strip()}\"")
         else:
-            raise RuntimeError(f"Could not understand argument \"{arg}\"")
+            yield line
+    if definition is not None:
+        raise RuntimeError("MACRO without ENDM")
 
-    assert all(arg_val <= 0xFF for arg_val in arg_list)
-    return [(arg_addressing_mode.high_nibble << 4) + mne.low_nibble] + arg_list
+def _define_macro(macros, arg):
+    name, *parameters = [] if arg is None else arg.split(None, 1)
+    parameters = _split_arguments(parameters[0]) if parameters else []
+    for word in [name] + parameters:
+        if not symbol_pattern.fullmatch(word):
+            raise RuntimeError(f"Could not understand macro definition \"MACRO {arg}\"")
+    if name in MNEMONIC or name in ('BYTE', 'EQU', 'MACRO', 'ENDM'):
+        raise RuntimeError(f"Macro \"{name}\" would replace a mnemonic")
+    if name in macros:
+        raise RuntimeError(f"Macro \"{name}\" is defined more than once")
+    macros[name] = Macro(parameters, [])
+    return macros[name]
 
-def preprocess(assembly_text):
-    instructions = []
-    labels = dict()
-    labels_lookup = dict() # reverse dict for retrieving the original label
+def _expand_macro(macros, uses, name, arg, depth):
+    if depth == MAX_MACRO_DEPTH:
+        raise RuntimeError(f"Macro \"{name}\" is nested more than {MAX_MACRO_DEPTH} deep")
+    macro = macros[name]
+    arguments = _split_arguments(arg) if arg is not None else []
+    if len(arguments) != len(macro.parameters):
+        raise RuntimeError(f"Macro \"{name}\" takes {len(macro.parameters)} arguments, got {len(arguments)}")
 
-    byte_location = 0x00
-    for line in assembly_text.split('\n'):
-        line = line.strip()
+    replacements = dict(zip(macro.parameters, arguments))
+    replacements['\\@'] = f"@{next(uses)}"
+    # parameters are whole words outside of hex values, such as $0a
+    pattern = re.compile('|'.join([r'\\@'] + [rf'(?<![\w$]){re.escape(p)}\b' for p in macro.parameters]))
+    for line in macro.body:
+        line = pattern.sub(lambda match: replacements[match[0]], line.split(';', 1)[0])
+        label, mnemonic, arg = tokenize(line)
+        if mnemonic in macros:
+            yield from _expand_macro(macros, uses, mnemonic, arg, depth + 1)
+        else:
+            yield line
 
-        # blank lines
-        if line == '':
-            continue
+def _split_arguments(arg):
+    return [argument.strip() for argument in arg.split(',')]
 
-        # remove comments
-        if line[0] == ';':
-            # full line comment
-            continue
+def format_listing_line(line):
+    hexdump = ' '.join([f"{new_byte:02X}" for new_byte in line.bytecode])
+    source = f"{line.source:10} :{line.label}" if line.label else line.source
+    return f"0x{line.address:02X}  {hexdump:8}# {source}"
+
+# symbols in macros may end in a suffix unique to each use, see expand_macros
+symbol_regex = r'[A-Za-z_]\w*(?:@[0-9]+)?'
+label_definition_pattern = re.compile(rf'({symbol_regex}):')
+symbol_pattern = re.compile(r'[A-Za-z_]\w*')
+constant_definition_pattern = re.compile(rf'(?P<name>{symbol_regex})\s+EQU\s+(?P<expression>.+)')
+# an expression, with the syntax of an addressing mode around it
+operand_pattern = re.compile(r'#(?P<immediate>.+)|\((?P<indirect>.+)\)|(?P<absolute>[^#(].*)')
+# $hex and decimal numbers, symbols, operators and brackets of an expression
+expression_token_pattern = re.compile(rf'\s*(?:\$(?P<hex>[0-9A-Fa-f]+)|(?P<decimal>[0-9]+)|(?P<symbol>{symbol_regex})|(?P<operator>[-+*/()]))')
+
+# operand syntax by the operand_pattern group matching its expression
+operand_syntax = {'absolute': '$', 'immediate': '#', 'indirect': '()'}
+
+# operand syntax of each addressing mode
+addressing_mode_syntax = (
+    (implied, ''),
+    (immediate, '#'),
+    (absolute, '$'),
+    (indirect, '()'),
+    (absolute_branching, '$'),
+    (indirect_branching, '()'),
+    )
+
+def generate_syntax_table(opcode_map):
+    """Build a dict of opcodes by (mnemonic, operand syntax)"""
+    table = dict()
+    for opcode, op in opcode_map.items():
+        syntax = next(syntax for adm, syntax in addressing_mode_syntax if adm is op.mode)
+        # This could only go wrong with misconfigured mnemonics
+        assert (op.mne.mnemonic, syntax) not in table, f"{op.mne.mnemonic} has two addressing modes written \"{syntax}\""
+        table[op.mne.mnemonic, syntax] = opcode
+    return table
+
+syntax_table = generate_syntax_table(opcode_map)
+
+def tokenize(line):
+    """(label defined, mnemonic, argument) of a source line, None for each missing"""
+    # remove comments
+    line = line.split(';', 1)[0].strip()
+    if line == '':
+        return None, None, None
+
+    label_definition = label_definition_pattern.fullmatch(line)
+    if label_definition:
+        return label_definition[1], None, None
+
+    # split on one or more whitespace chars
+    split_line = line.split(None, 1)
+    if len(split_line) == 1:
+        return None, line, None
+    return None, split_line[0], split_line[1]
+
+@functools.lru_cache(maxsize=4096)
+def parse_operand(arg):
+    """
+    (syntax, value, expression) of an instruction argument, an expression
+    naming symbols is left for link() and its value is None
+    """
+    if arg is None:
+        return '', None, None
+
+    operand = operand_pattern.fullmatch(arg)
+    if operand is None:
+        raise RuntimeError(f"Could not understand argument \"{arg}\"")
+    syntax = operand_syntax[operand.lastgroup]
+
+    expression = operand[operand.lastgroup].strip()
+    code, names = compile_expression(expression)
+    if names:
+        return syntax, None, expression
+    return syntax, operand_byte(evaluate(expression, {}), expression), None
+
+@functools.lru_cache(maxsize=4096)
+def compile_expression(expression):
+    """
+    (code, symbol names) of a constant expression of $hex and decimal
+    numbers, symbols, + - * / and brackets, / dividing integers
+
+    The code reads the value of the nth symbol name from _s<n>.
+    """
+    python = []
+    names = []
+    position = 0
+    while position < len(expression.rstrip()):
+        token = expression_token_pattern.match(expression, position)
+        if token is None:
+            raise RuntimeError(f"Could not understand expression \"{expression}\"")
+        position = token.end()
+        if token['hex'] is not None:
+            python.append(str(int(token['hex'], 16)))
+        elif token['decimal'] is not None:
+            python.append(str(int(token['decimal'])))
+        elif token['symbol'] is not None:
+            # symbols become placeholders, so none can be taken for a Python name
+            if token['symbol'] not in names:
+                names.append(token['symbol'])
+            python.append(f"_s{names.index(token['symbol'])}")
         else:
-            line = line.split(';', 1)[0]
-            line = line.strip()
+            python.append('//' if token['operator'] == '/' else token['operator'])
+    try:
+        code = compile(' '.join(python), "<expression>", 'eval')
+    except SyntaxError:
+        raise RuntimeError(f"Could not understand expression \"{expression}\"") from None
+    return code, tuple(names)
 
-        # label definition
-        if len(line.split()) == 1 and line[-1] == ':':
-            labels[line[:-1]] = byte_location # all but last char
-            labels_lookup[byte_location] = line[:-1] # The reverse dict
-            continue
+def evaluate(expression, symbols):
+    """Value of a constant expression, symbols maps names to values"""
+    code, names = compile_expression(expression)
+    try:
+        values = {f"_s{n}": symbols[name] for n, name in enumerate(names)}
+    except KeyError as error:
+        raise RuntimeError(f"Undefined symbol \"{error.args[0]}\" in \"{expression}\"") from None
+    try:
+        return eval(code, {'__builtins__': {}}, values)
+    except ZeroDivisionError:
+        raise RuntimeError(f"Division by zero in \"{expression}\"") from None
+
+def operand_byte(value, expression):
+    if not 0x00 <= value <= 0xFF:
+        raise RuntimeError(f"\"{expression}\" is {value}, which does not fit in a byte")
+    return value
+
+def encode_instruction(mnemonic, syntax, value=None):
+    try:
+        opcode = syntax_table[mnemonic, syntax]
+    except KeyError:
+        raise RuntimeError(f"{mnemonic} has no addressing mode written \"{syntax}\"") from None
+    if value is None:
+        return [opcode]
+    assert value <= 0xFF
+    return [opcode, value]
 
-        try:
-            byte_location += len(translate_instruction(line))
-        except RuntimeError:
-            byte_location += 2 # assume we are dealing with a 2 byte instruction, e.g. an unsubstituted label
+def translate_bytes(arg):
+    assert arg is not None and arg[0] == '#', "BYTES must follow this syntax: \"BYTES #09 33 FA ...\""
+    return [int(byte, 16) for byte in arg[1:].split()]
 
+def translate_instruction(instruction):
+    # split on one or more whitespace chars
+    split_instruction = instruction.split(None, 1)
+    mnemonic = split_instruction[0]
+    arg = split_instruction[1] if len(split_instruction) == 2 else None
 
-        instructions.append(line)
+    if mnemonic == 'BYTE':
+        return translate_bytes(arg)
 
-    label_subbed_instructions = []
-    for i in instructions:
-        for label, label_location in labels.items():
-            i = i.replace(label, f"${label_location:02X}")
-        label_subbed_instructions.append(i)
-    return label_subbed_instructions, labels_lookup
+    syntax, value, expression = parse_operand(arg)
+    if expression is not None:
+        raise RuntimeError(f"Could not understand argument \"{arg}\", symbols are resolved by assemble")
+    return encode_instruction(mnemonic, syntax, value)
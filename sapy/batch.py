@@ -0,0 +1,228 @@
+import numpy as np # type: ignore
+
+from sapy.components import opcode_map, instruction_table, RunResult, \
+    implied, immediate, absolute, indirect, absolute_branching, indirect_branching
+
+### Vectorized addressing modes and mnemonics ###
+# Each function updates the machines selected by the index array idx in
+# the same way the instruction interpreter updates a single Computer.
+def _implied(bc, idx):
+    pass
+
+def _next_memory_loc(bc, idx):
+    bc.mar[idx] = bc.pc[idx]
+    bc.pc[idx] = (bc.pc[idx] + 1) % (0xFF + 1)
+
+def _operand_address(bc, idx):
+    _next_memory_loc(bc, idx)
+    bc.mar[idx] = bc.ram[idx, bc.mar[idx]]
+
+def _indirect_operand_address(bc, idx):
+    _operand_address(bc, idx)
+    bc.mar[idx] = bc.pc[idx]
+    bc.mar[idx] = bc.ram[idx, bc.mar[idx]]
+
+addressing_operations = (
+    (implied, _implied),
+    (immediate, _next_memory_loc),
+    (absolute, _operand_address),
+    (indirect, _indirect_operand_address),
+    (absolute_branching, _next_memory_loc),
+    (indirect_branching, _operand_address),
+    )
+
+def _read(bc, idx):
+    return bc.ram[idx, bc.mar[idx]]
+
+def _alu(bc, idx, result):
+    wrapped = result % (0xFF + 1)
+    bc.zero[idx] = wrapped == 0
+    bc.nz[idx] = wrapped != 0
+    bc.carry[idx] = wrapped != result
+    bc.reg_a[idx] = wrapped
+
+def _display(bc, idx, values):
+    bc.reg_o[idx] = values
+    for machine, value in zip(idx.tolist(), values.tolist()):
+        bc.outputs[machine].append(value)
+
+def _lda(bc, idx):
+    bc.reg_a[idx] = _read(bc, idx)
+
+def _add(bc, idx):
+    bc.reg_b[idx] = _read(bc, idx)
+    _alu(bc, idx, bc.reg_a[idx] + bc.reg_b[idx])
+
+def _sub(bc, idx):
+    bc.reg_b[idx] = _read(bc, idx)
+    _alu(bc, idx, bc.reg_a[idx] - bc.reg_b[idx])
+
+def _out(bc, idx):
+    _display(bc, idx, _read(bc, idx))
+
+def _jmp(bc, idx):
+    bc.pc[idx] = _read(bc, idx)
+
+def _bnz(bc, idx):
+    taken = idx[bc.nz[idx]]
+    bc.pc[taken] = _read(bc, taken)
+
+def _sta(bc, idx):
+    bc.mar[idx] = _read(bc, idx)
+    bc.ram[idx, bc.mar[idx]] = bc.reg_a[idx]
+
+def _ota(bc, idx):
+    _display(bc, idx, bc.reg_a[idx])
+
+def _bai(bc, idx):
+    values = np.array([bc.input_function(machine) for machine in idx.tolist()], dtype=np.int16)
+    if not ((0x00 <= values) & (values <= 0xFF)).all():
+        raise ValueError("data bus is limited to 8 bits")
+    bc.reg_c[idx] = values
+    bc.reg_a[idx] = values
+
+def _dma(bc, idx):
+    # nothing observable changes without a dma handler
+    pass
+
+def _nop(bc, idx):
+    pass
+
+def _hlt(bc, idx):
+    bc.pc[idx] -= 1 # move back to halt instuction
+    bc.halted[idx] = True
+
+mnemonic_operations = {
+    'LDA': _lda,
+    'ADD': _add,
+    'SUB': _sub,
+    'OUT': _out,
+    'JMP': _jmp,
+    'BNZ': _bnz,
+    'STA': _sta,
+    'OTA': _ota,
+    'BAI': _bai,
+    'DMA': _dma,
+    'NOP': _nop,
+    'HLT': _hlt,
+    }
+
+def generate_batch_table(opcode_map):
+    """
+    Build a 256 entry table of (addressing operation, mnemonic operation, T-states)
+    Non-existant opcodes execute NOP, as they do in Clock.decode
+    """
+    table = dict()
+    for opcode, op in opcode_map.items():
+        address_fxn = next(f for adm, f in addressing_operations if adm is op.mode)
+        table[opcode] = (address_fxn, mnemonic_operations[op.mne.mnemonic])
+    nop = table[0xFE]
+    return [table.get(opcode, nop) + (instruction_table[opcode][2],) for opcode in range(0xFF + 1)]
+
+batch_table = generate_batch_table(opcode_map)
+
+class BatchComputer():
+    """
+    N computers stepped in lockstep, one instruction at a time
+
+    RAM is an (N, 256) uint8 array and every register a length N array.
+    Each step groups the running machines by opcode and applies the
+    operation to each group at once. Machines halt independently.
+    """
+    def __init__(self, n):
+        self.n = n
+        self.reset()
+
+    def reset(self):
+        n = self.n
+        self.ram = np.zeros((n, 0xFF + 1), dtype=np.uint8)
+        # int16 as halting at 0xFF moves the program counter back to -1
+        self.pc = np.zeros(n, dtype=np.int16)
+        self.mar = np.zeros(n, dtype=np.int16)
+        self.reg_a = np.zeros(n, dtype=np.int16)
+        self.reg_b = np.zeros(n, dtype=np.int16)
+        self.reg_o = np.zeros(n, dtype=np.int16)
+        self.reg_c = np.zeros(n, dtype=np.int16)
+        self.reg_i = np.zeros(n, dtype=np.int16)
+        self.nz = np.ones(n, dtype=bool)
+        self.zero = np.zeros(n, dtype=bool)
+        self.carry = np.zeros(n, dtype=bool)
+        self.halted = np.zeros(n, dtype=bool)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        self.instructions = np.zeros(n, dtype=np.int64)
+        self.outputs = [[] for _ in range(n)]
+        self._inputs = [iter(()) for _ in range(n)]
+
+    def load_programs(self, programs):
+        assert len(programs) <= self.n, "More programs than machines"
+        for machine, program in enumerate(programs):
+            program = bytes(program)
+            if len(program) > 0xFF + 1:
+                raise ValueError("data does not fit in memory")
+            self.ram[machine, :len(program)] = np.frombuffer(program, dtype=np.uint8)
+
+    def load_inputs(self, inputs):
+        """Values each machine's BAI instructions read, in order"""
+        self._inputs = [iter(values) for values in inputs]
+
+    def input_function(self, machine):
+        try:
+            return next(self._inputs[machine])
+        except StopIteration:
+            raise RuntimeError(f"Machine {machine} ran out of input") from None
+
+    def step(self, active=None):
+        """Execute one instruction on every active machine, by default all running ones"""
+        if active is None:
+            active = ~self.halted
+        idx = np.flatnonzero(active & ~self.halted)
+        if len(idx) == 0:
+            return
+
+        # fetch
+        _next_memory_loc(self, idx)
+        opcodes = self.ram[idx, self.mar[idx]].astype(np.int16)
+        self.reg_i[idx] = opcodes
+
+        order = np.argsort(opcodes, kind='stable')
+        opcodes = opcodes[order]
+        idx = idx[order]
+        starts = np.flatnonzero(np.diff(opcodes, prepend=-1))
+        for group in np.split(np.arange(len(idx)), starts[1:]):
+            address_fxn, operation_fxn, t_states = batch_table[opcodes[group[0]]]
+            group_idx = idx[group]
+            address_fxn(self, group_idx)
+            operation_fxn(self, group_idx)
+            self.cycles[group_idx] += t_states
+
+        self.instructions[idx] += 1
+
+    def run(self, max_cycles=None, max_instructions=None):
+        """
+        Run every machine until it halts or uses up its budget,
+        budgets are per machine and behave as in Computer.run
+        """
+        start_cycles = self.cycles.copy()
+        start_instructions = self.instructions.copy()
+        while True:
+            active = ~self.halted
+            if max_cycles is not None:
+                active &= self.cycles - start_cycles < max_cycles
+            if max_instructions is not None:
+                active &= self.instructions - start_instructions < max_instructions
+            if not active.any():
+                break
+            self.step(active)
+
+        results = []
+        for machine in range(self.n):
+            cycles = int(self.cycles[machine] - start_cycles[machine])
+            instructions = int(self.instructions[machine] - start_instructions[machine])
+            if self.halted[machine]:
+                halt_reason = 'halted'
+            elif max_cycles is not None and cycles >= max_cycles:
+                halt_reason = 'max_cycles'
+            else:
+                halt_reason = 'max_instructions'
+            results.append(RunResult(cycles=cycles, instructions=instructions, halt_reason=halt_reason))
+        return results
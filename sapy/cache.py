@@ -0,0 +1,133 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+from collections import OrderedDict
+from typing import Optional
+
+from sapy.components import mnemonics, generate_opcode_map, fetch_microcode, ConditionalMnemonic, control_names, \
+    SNAPSHOT_VERSION
+from sapy.parallel import ProgramResult, RESULT_FORMAT, program_bytes, run_program
+
+def definitions_version(mnemonics=mnemonics):
+    """
+    Hash of the instruction set built from mnemonics and its microcode,
+    changes whenever any opcode behaves differently
+    """
+    def names(microcode):
+        return [sorted(control_names(con)) for con in microcode]
+
+    opcode_map = generate_opcode_map(mnemonics)
+    definitions = [names(fetch_microcode)]
+    for opcode in sorted(opcode_map):
+        op = opcode_map[opcode]
+        definition = [opcode, op.mne.mnemonic, names(op.mode.arg_fetch_microcode), names(op.mne.operation_microcode)]
+        if isinstance(op.mne, ConditionalMnemonic):
+            definition += [names(op.mne.operation_microcode_false), op.mne.test_fxn.__qualname__]
+        definitions.append(definition)
+    return hashlib.sha256(repr(definitions).encode()).hexdigest()
+
+VERSION = definitions_version()
+
+class ResultCache():
+    """
+    Least recently used cache of ProgramResults in front of run_program
+
+    Entries are keyed on the RAM image after loading the program, the BAI
+    inputs, the run budgets, the version of the instruction set and the
+    formats of stored results and snapshots, so results of older
+    definitions or formats are never returned.
+
+    maxsize
+        number of results kept in memory
+    directory
+        optional directory to also store results in, shared between
+        caches and processes
+    """
+    def __init__(self, maxsize=1024, directory=None, version=VERSION):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Forget the results in memory, the directory is left alone"""
+        self._entries.clear()
+
+    def key(self, program, inputs=(), max_cycles=None, max_instructions=None):
+        # programs are loaded into cleared RAM
+        image = program_bytes(program).ljust(0xFF + 1, b'\x00')
+        key = hashlib.sha256(self.version.encode())
+        key.update(f"{SNAPSHOT_VERSION} {RESULT_FORMAT}".encode())
+        key.update(image)
+        key.update(repr((tuple(inputs), max_cycles, max_instructions)).encode())
+        return key.hexdigest()
+
+    def get(self, key) -> Optional[ProgramResult]:
+        """Result stored under key or None"""
+        try:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        except KeyError:
+            pass
+
+        result = self._read(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        self._remember(key, result)
+        self._write(key, result)
+
+    def run(self, program, inputs=(), max_cycles=None, max_instructions=None) -> ProgramResult:
+        """run_program, returning the stored result when there is one"""
+        program = program_bytes(program)
+        key = self.key(program, inputs, max_cycles, max_instructions)
+        result = self.get(key)
+        if result is None:
+            result = run_program(program, inputs, max_cycles, max_instructions)
+            self.put(key, result)
+        return result
+
+    def _remember(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def _read(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (EOFError, pickle.UnpicklingError, AttributeError, TypeError):
+            # a truncated, corrupt or stale entry is a miss, and is written again
+            return None
+
+    def _write(self, key, result):
+        if self.directory is None:
+            return
+        # write then rename, so readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(temp_path, self._path(key))
@@ -1,31 +1,107 @@
-from typing import Tuple
+import random
+import struct
+
+from typing import Optional, Tuple
 
 import numpy as np # type: ignore
 
 from dataclasses import dataclass
 
+### Control Bus ###
+# Each control signal is one bit of an integer control word
+control_bits = dict()
+
+def control_bit(name):
+    """Bit for the control signal name, new names get the next free bit"""
+    try:
+        return control_bits[name]
+    except KeyError:
+        bit = 1 << len(control_bits)
+        control_bits[name] = bit
+        return bit
+
+def encode_control(con):
+    """Control word for an iterable of control signal names, ints pass through"""
+    if con.__class__ is int:
+        return con
+    word = 0
+    for name in con:
+        word |= control_bit(name)
+    return word
+
+def control_names(con):
+    """Control signal names of a control word, for debugging"""
+    if con.__class__ is not int:
+        return tuple(con)
+    return tuple(name for name, bit in control_bits.items() if con & bit)
+
+def compile_microcode(microcode):
+    """Encode each control word of a microcode sequence"""
+    return tuple(encode_control(con) for con in microcode)
+
+EP = control_bit('ep') # program counter enable
+LM = control_bit('lm') # memory address register latch
+CP = control_bit('cp') # program counter increment
+ER = control_bit('er') # ram enable
+LI = control_bit('li') # instruction register latch
+LR = control_bit('lr') # ram latch
+EA = control_bit('ea') # a register enable
+LA = control_bit('la') # a register latch
+LB = control_bit('lb') # b register latch
+EU = control_bit('eu') # arithmetic unit enable
+SU = control_bit('su') # arithmetic unit subtract
+LO = control_bit('lo') # output register latch
+LP = control_bit('lp') # program counter latch
+HP = control_bit('hp') # program counter halt
+EC = control_bit('ec') # input register enable
+DMA_REQ = control_bit('dma') # dma transfer
+
 ### Components ###
 class Register():
     def __init__(self, name):
         self._name = name
-        self.latch_bit = 'l' + name
-        self.enable_bit = 'e' + name
+        self.latch_bit = control_bit('l' + name)
+        self.enable_bit = control_bit('e' + name)
         self.reset()
 
     def reset(self):
         self.value = 0x00
 
-    def clock(self, *, data=None, con=[]):
-        if self.latch_bit in con:
-            assert not data is None, "Data method should always return a value"
-            if not (0x00 <= data <= 0xFF):
-                raise ValueError("data bus is limited to 8 bits")
-            self.value = data
+    def clock(self, *, data=None, con=0):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & self.latch_bit:
+            self.latch(data)
 
-    def data(self, con=[]):
-        if self.enable_bit in con:
+    def data(self, con=0):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & self.enable_bit:
             return self.value
 
+    def latch(self, data):
+        assert not data is None, "Data method should always return a value"
+        if not (0x00 <= data <= 0xFF):
+            raise ValueError("data bus is limited to 8 bits")
+        self.value = data
+
+    def read(self):
+        return self.value
+
+    def compile_data(self, con):
+        """Return a callable which puts this component on the bus for con, or None"""
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & self.enable_bit:
+            return self.read
+
+    def compile_clock(self, con):
+        """Return a callable which latches the bus for con, or None"""
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & self.latch_bit:
+            return self.latch
+
 class RegisterA(Register):
     def __init__(self):
         super().__init__(name='a')
@@ -34,24 +110,33 @@ class RegisterB(Register):
     def __init__(self):
         super().__init__(name='b')
 
-    def data(self, con=[]):
+    def data(self, con=0):
         """B Register does not output ever"""
         return None
 
+    def compile_data(self, con):
+        return None
+
 class MemoryAddressRegister(Register):
     def __init__(self):
         super().__init__(name='m')
 
-    def data(self, con=[]):
+    def data(self, con=0):
         """mar never outputs to the bus"""
         return None
 
+    def compile_data(self, con):
+        return None
+
 class ProgramCounter(Register):
     def __init__(self):
         super().__init__(name='p')
+
+    def reset(self):
+        super().reset()
         self.halted = False
 
-    def clock(self, *, data=None, con=[]):
+    def clock(self, *, data=None, con=0):
         """
         Control Bits
         ------------
@@ -60,64 +145,246 @@ class ProgramCounter(Register):
         hp
             Halt the program counter
         """
-        assert not (('cp' in con) and ('lp' in con)) # either increment or latch or neither
+        if con.__class__ is not int:
+            con = encode_control(con)
+        assert not ((con & CP) and (con & LP)) # either increment or latch or neither
         if self.halted:
             return
 
-        if 'cp' in con and not self.halted:
-            self.value += 1
-            # Handel overflows
-            base = 1 << 8 # eight bits
-            self.value = self.value % base
-        elif 'lp' in con:
-            self.value = data
-        elif 'hp' in con:
-            self.value -= 1 # move back to halt instuction
-            self.halted = True
+        if con & CP and not self.halted:
+            self.increment()
+        elif con & LP:
+            self.jump(data)
+        elif con & HP:
+            self.halt()
+
+    def increment(self, data=None):
+        if self.halted:
+            return
+        self.value += 1
+        # Handel overflows
+        base = 1 << 8 # eight bits
+        self.value = self.value % base
+
+    def jump(self, data):
+        if self.halted:
+            return
+        self.value = data
+
+    def halt(self, data=None):
+        if self.halted:
+            return
+        self.value -= 1 # move back to halt instuction
+        self.halted = True
+
+    def compile_clock(self, con):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        assert not ((con & CP) and (con & LP)) # either increment or latch or neither
+        if con & CP:
+            return self.increment
+        elif con & LP:
+            return self.jump
+        elif con & HP:
+            return self.halt
 
 class RegisterOutput(Register):
     def __init__(self):
         super().__init__(name='o')
         self.output_function = lambda x: print(f"Output Display: {x:X}")
 
-    def data(self, con=[]):
+    def data(self, con=0):
         return None
 
-    def clock(self, *, data=None, con=[]):
+    def clock(self, *, data=None, con=0):
+        if con.__class__ is not int:
+            con = encode_control(con)
         super().clock(data=data, con=con)
-        if 'lo' in con:
+        if con & LO:
             self.output_function(self.value)
 
+    def display(self, data):
+        self.latch(data)
+        self.output_function(self.value)
+
+    def compile_data(self, con):
+        return None
+
+    def compile_clock(self, con):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & LO:
+            return self.display
+
 class RegisterInput(Register):
     def __init__(self):
         super().__init__(name='c')
         self.value = 0
         self.input_function = lambda: int(input(f"Enter a Hexadecimal number 00 <= x <= FF:\n"), 16)
 
-    def data(self, con=[]):
-        if 'ec' in con:
+    def data(self, con=0):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & EC:
             self.value = self.input_function()
         return super().data(con=con)
 
+    def read_input(self):
+        self.value = self.input_function()
+        return self.value
+
+    def compile_data(self, con):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & EC:
+            return self.read_input
+
+# Zobrist table, one random 64 bit key per (address, value), the fingerprint
+# of memory is the xor of the keys of its bytes. The seed is fixed so
+# fingerprints agree between processes.
+def _generate_zobrist_table(seed=0x5A9):
+    rng = random.Random(seed)
+    return [[rng.getrandbits(64) for value in range(0xFF + 1)] for address in range(0xFF + 1)]
+
+zobrist_table = _generate_zobrist_table()
+EMPTY_MEMORY_FINGERPRINT = 0
+for _row in zobrist_table:
+    EMPTY_MEMORY_FINGERPRINT ^= _row[0x00]
+del _row
+
 class RandomAccessMemory():
+    """
+    256 bytes of memory
+
+    fingerprint is a running hash of the contents, kept up to date by load()
+    and write(). Watchers are called when memory they watch is written.
+    generation counts the block changes by load(), restore() and reset().
+    Writing through values or array() bypasses all three, call rehash()
+    afterwards.
+    """
     def __init__(self, mar):
         self._mar = mar
+        self.memory = bytearray(0xFF + 1) # 256 total values
+        # zero-copy view of memory, stays valid across resets
+        self.values = memoryview(self.memory)
+        # callbacks watching each address, see watch()
+        self._watchers = [()] * len(self.memory)
+        # watches that also see block changes
+        self._watching = 0
+        self.generation = 0
         self.reset()
 
     def reset(self):
-        self.values = {x: 0x00 for x in range(0xFF + 1)} # 256 total values
+        self.restore(bytes(len(self.memory)), EMPTY_MEMORY_FINGERPRINT)
 
-    def clock(self, *, data=None, con=[]):
-        if 'lr' in con:
-            assert not data is None
-            self.values[self._mar.value] = data
+    def rehash(self):
+        """Recompute fingerprint from the contents of memory"""
+        fingerprint = 0
+        for row, value in zip(zobrist_table, self.memory):
+            fingerprint ^= row[value]
+        self.fingerprint = fingerprint
 
-    def data(self, con=[]):
-        if 'er' in con:
+    def watch(self, start, stop, callback, writes_only=False):
+        """
+        Call callback(address, value) after memory in range(start, stop) is
+        written, by write() or by load(), restore() and reset() changing it.
+        With writes_only, block changes are left to generation and don't
+        cost a comparison of the old and new memory.
+        Returns a handle for unwatch().
+        """
+        for address in range(start, stop):
+            self._watchers[address] += (callback,)
+        self._watching += not writes_only
+        return (start, stop, callback, writes_only)
+
+    def unwatch(self, handle):
+        start, stop, callback, writes_only = handle
+        for address in range(start, stop):
+            watchers = list(self._watchers[address])
+            watchers.remove(callback)
+            self._watchers[address] = tuple(watchers)
+        self._watching -= not writes_only
+
+    def _notify_changes(self, address, old):
+        for offset, before in enumerate(old):
+            after = self.memory[address + offset]
+            if before != after:
+                for callback in self._watchers[address + offset]:
+                    callback(address + offset, after)
+
+    def array(self):
+        """Zero-copy uint8 numpy view of memory"""
+        return np.frombuffer(self.memory, dtype=np.uint8)
+
+    def load(self, data, address=0x00):
+        """Copy a block of bytes into memory starting at address"""
+        data = bytes(data)
+        if not (0x00 <= address and address + len(data) <= len(self.memory)):
+            raise ValueError("data does not fit in memory")
+        old = self.memory[address:address + len(data)]
+        self.memory[address:address + len(data)] = data
+        self.generation += 1
+
+        fingerprint = self.fingerprint
+        for row, before, after in zip(zobrist_table[address:], old, data):
+            if before != after:
+                fingerprint ^= row[before] ^ row[after]
+        self.fingerprint = fingerprint
+
+        if self._watching:
+            self._notify_changes(address, old)
+
+    def restore(self, memory, fingerprint):
+        """Replace all of memory with a copy whose fingerprint is already known"""
+        if len(memory) != len(self.memory):
+            raise ValueError("data does not fit in memory")
+        old = bytes(self.memory) if self._watching else None
+        self.memory[:] = memory
+        self.fingerprint = fingerprint
+        self.generation += 1
+
+        if old is not None:
+            self._notify_changes(0x00, old)
+
+    def clock(self, *, data=None, con=0):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & LR:
+            self.write(data)
+
+    def data(self, con=0):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & ER:
             return self.values[self._mar.value]
         else:
             return None
 
+    def read(self):
+        return self.values[self._mar.value]
+
+    def write(self, data):
+        assert not data is None
+        address = self._mar.value
+        before = self.values[address]
+        self.values[address] = data
+        row = zobrist_table[address]
+        self.fingerprint ^= row[before] ^ row[data]
+        for callback in self._watchers[address]:
+            callback(address, data)
+
+    def compile_data(self, con):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & ER:
+            return self.read
+
+    def compile_clock(self, con):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & LR:
+            return self.write
+
 class ArithmeticUnit():
     def __init__(self, accumulator, reg_b):
         self.accumulator = accumulator
@@ -125,31 +392,53 @@ class ArithmeticUnit():
         self.reset()
 
     def reset(self):
-        pass
+        # Flags for the last ALU result
+        self.nz = True # not zero
+        self.zero = False
+        self.carry = False # result did not fit in 8 bits
 
-    def clock(self, *, data=None, con=[]):
+    def clock(self, *, data=None, con=0):
         # ArithmeticUnit is static realtime
         pass
 
-    def data(self, con=[]):
-        if not 'eu' in con:
+    def data(self, con=0):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if not con & EU:
             return None
 
-        if not 'su' in con:
-            a = self.accumulator.value + self.reg_b.value
-        elif 'su' in con:
-            a =  self.accumulator.value - self.reg_b.value
+        if not con & SU:
+            return self.add()
+        elif con & SU:
+            return self.subtract()
 
+    def add(self):
+        return self._result(self.accumulator.value + self.reg_b.value)
+
+    def subtract(self):
+        return self._result(self.accumulator.value - self.reg_b.value)
+
+    def compile_data(self, con):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if not con & EU:
+            return None
+        elif not con & SU:
+            return self.add
+        else:
+            return self.subtract
+
+    def compile_clock(self, con):
+        return None
+
+    def _result(self, a):
         # Handel overflows
         base = 1 << 8 # eight bits
         result = a % base
 
-        # set the global flag
-        global NZ
-        if result == 0:
-            NZ = False
-        else:
-            NZ = True
+        self.zero = result == 0
+        self.nz = not self.zero
+        self.carry = result != a
 
         return result
 
@@ -157,15 +446,29 @@ class RegisterInstruction(Register):
     def __init__(self):
         super().__init__(name='o')
 
-    def clock(self, *, data=None, con=[]):
-        if 'li' in con:
-            assert not data is None
-            assert 0x00 <= data <= 0xFF
-            self.value = data
+    def clock(self, *, data=None, con=0):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & LI:
+            self.latch(data)
 
-    def data(self, con=[]):
+    def data(self, con=0):
         return None
 
+    def latch(self, data):
+        assert not data is None
+        assert 0x00 <= data <= 0xFF
+        self.value = data
+
+    def compile_data(self, con):
+        return None
+
+    def compile_clock(self, con):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & LI:
+            return self.latch
+
 ### Controller Parts ###
 class SwitchBoard():
     def __init__(self, ram, mar):
@@ -178,17 +481,22 @@ class SwitchBoard():
         self.data = 0x00
 
     def load_program(self, program):
-        self.address = 0x00
-        for opcode in program:
-            self.data = opcode
-            self.write_ram_location()
-            self.address += 1
+        program = bytes(program)
+        self._ram.load(program, address=0x00)
+        if program:
+            self.data = program[-1]
+        self.address = len(program)
+
+    def load_patch(self, patch):
+        """Write (address, bytes) runs into memory, see sapy.assembler.AssemblerSession"""
+        for address, data in patch:
+            self._ram.load(data, address=address)
 
     def write_ram_location(self):
         # store address for ram in register
-        self._mar.clock(data=self.address, con=['lm'])
+        self._mar.clock(data=self.address, con=LM)
         # clock data into ram at the address set above
-        self._ram.clock(data=self.data, con=['lr'])
+        self._ram.clock(data=self.data, con=LR)
 
 class DMAReader():
     def __init__(self, ram, mar):
@@ -196,42 +504,52 @@ class DMAReader():
         self._mar = mar
         def handler(ram_array):
             print(ram_array)
-        self.set_dma_handler = handler
+        self._dma_handler = handler
 
     def reset(self):
         pass
 
     def read_ram(self):
-        bitmap = np.zeros((0xF + 1, 0xF + 1))
-
-        for address_high in range(0x0, 0xF + 1):
-            for address_low in range(0x0, 0xF + 1):
-                byte = self.read_ram_location(address_high, address_low)
-                bitmap[address_high, address_low] = byte
-        return bitmap
+        """Live 16x16 view of ram, copy it to keep a snapshot"""
+        return self._ram.array().reshape(0xF + 1, 0xF + 1)
 
     def read_ram_location(self, address_high, address_low):
         address = (address_high << 4) + address_low
-        self._mar.clock(data=address, con=['lm'])
-        byte = self._ram.data(con=['er'])
+        self._mar.clock(data=address, con=LM)
+        byte = self._ram.data(con=ER)
         return byte
 
     def connect_dma_handler(self, handler):
         self._dma_handler = handler
 
-    def clock(self, *, data=None, con=[]):
-        if 'dma' in con:
-            if self._dma_handler is None:
-                # don't dump the numpy array if set to None
-                return
-            self._dma_handler(self.read_ram())
+    def clock(self, *, data=None, con=0):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & DMA_REQ:
+            self.transfer()
 
-    def data(self, con=[]):
+    def data(self, con=0):
         return None
 
+    def transfer(self, data=None):
+        if self._dma_handler is None:
+            # don't dump the numpy array if set to None
+            return
+        self._dma_handler(self.read_ram())
+
+    def compile_data(self, con):
+        return None
+
+    def compile_clock(self, con):
+        if con.__class__ is not int:
+            con = encode_control(con)
+        if con & DMA_REQ:
+            return self.transfer
+
 @dataclass
 class AddressingMode:
-    arg_fetch_microcode: Tuple[Tuple[str]]
+    # control words, see compile_microcode
+    arg_fetch_microcode: Tuple[int, ...]
     high_nibble: int
     def is_my_argtype(arg):
        # return true if pass argument is of your type
@@ -240,11 +558,14 @@ class AddressingMode:
 @dataclass
 class Mnemonic:
     # do something with ram at the operand address, eg er to use, lr to save
-    operation_microcode: Tuple[Tuple[str]]
+    operation_microcode: Tuple[int, ...]
     low_nibble: int
     addressing_modes: Tuple[AddressingMode]
     mnemonic: str
 
+    def select_microcode(self, alu):
+        return self.operation_microcode
+
     def detect_addressing_mode(arg):
         detected_modes = []
         for mode in addressing_modes:
@@ -261,10 +582,10 @@ class OpCode:
     mne: Mnemonic
     mode: AddressingMode
 
-    def decode(self):
+    def decode(self, alu=None):
         return fetch_microcode \
             + self.mode.arg_fetch_microcode \
-            + self.mne.operation_microcode
+            + self.mne.select_microcode(alu)
 
 def generate_opcode_map(mnemonics):
     opcode_map = dict()
@@ -274,10 +595,10 @@ def generate_opcode_map(mnemonics):
             opcode_map[opcode] = OpCode(mne, adm)
     return opcode_map
 
-fetch_microcode = (
+fetch_microcode = compile_microcode((
     ('ep', 'lm', 'cp'), # get next memory loc
     ('er', 'li'),       # put that opcode at that loc into instruction register 
-    )
+    ))
 
 implied = AddressingMode(
     arg_fetch_microcode=tuple(),
@@ -285,88 +606,88 @@ implied = AddressingMode(
     )
 
 immediate = AddressingMode(
-    arg_fetch_microcode=(
+    arg_fetch_microcode=compile_microcode((
         ('ep', 'lm', 'cp'), # get next memory loc
-        ),
+        )),
     high_nibble=0x2,
     )
 
 absolute = AddressingMode(
-    arg_fetch_microcode=(
+    arg_fetch_microcode=compile_microcode((
         ('ep', 'lm', 'cp'), # get next memory loc
         ('er', 'lm'),       # get operand address from next memory loc
-        ),
+        )),
     high_nibble=0x0,
     )
 
 indirect = AddressingMode(
-    arg_fetch_microcode=(
+    arg_fetch_microcode=compile_microcode((
         ('ep', 'lm', 'cp'), # get next memory loc
         ('er', 'lm'),       # get operand address from next memory loc
         ('ep', 'lm'),       # get next memory loc
         ('er', 'lm'),       # get operand address from next memory loc
-        ),
+        )),
     high_nibble=0x1,
     )
 
 absolute_branching = AddressingMode(
-    arg_fetch_microcode=(
+    arg_fetch_microcode=compile_microcode((
         ('ep', 'lm', 'cp'), # get next memory loc
-        ),
+        )),
     high_nibble=0x3,
     )
 
 indirect_branching = AddressingMode(
-    arg_fetch_microcode=(
+    arg_fetch_microcode=compile_microcode((
         ('ep', 'lm', 'cp'), # get next memory loc
         ('er', 'lm'),       # get operand address from next memory loc
-        ),
+        )),
     high_nibble=0x4,
     )
 
 # Mnemonics
 LDA = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         ('er', 'la'),
-        ),
+        )),
     low_nibble=0x0,
     addressing_modes=(immediate, absolute, indirect),
     mnemonic='LDA'
     )
 
 ADD = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         ('er', 'lb'),
         ('eu', 'la'),
-        ),
+        )),
     low_nibble=0x1,
     addressing_modes=(immediate, absolute, indirect),
     mnemonic='ADD'
     )
 
 SUB = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         ('er', 'lb'),
         ('eu', 'la', 'su'),
-        ),
+        )),
     low_nibble=0x2,
     addressing_modes=(immediate, absolute, indirect),
     mnemonic='SUB'
     )
 
 OUT = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         ('er', 'lo'),
-        ),
+        )),
     low_nibble=0x3,
     addressing_modes=(immediate, absolute, indirect),
     mnemonic='OUT'
     )
 
 JMP = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         ('er', 'lp'),
-        ),
+        )),
     low_nibble=0x4,
     addressing_modes=(absolute_branching, indirect_branching),
     mnemonic='JMP'
@@ -386,29 +707,24 @@ class ConditionalMnemonic(Mnemonic):
         self.operation_microcode_false = operation_microcode_false
         self.test_fxn = test_fxn
 
-    def __getattribute__(self, name):
-        if name == "operation_microcode":
-            if self.test_fxn():
-                return self.operation_microcode_true
-            else:
-                return self.operation_microcode_false
+    def select_microcode(self, alu):
+        """Pick the microcode from the flags of alu, without one assume a reset ALU"""
+        if alu is None or self.test_fxn(alu):
+            return self.operation_microcode_true
         else:
-            return object.__getattribute__(self, name)
-
+            return self.operation_microcode_false
 
-# # Global Flag for ALU results
-# # NE not equal
-NZ = True
-def not_zero():
-    return NZ
+# Tests of the ALU flags
+def not_zero(alu):
+    return alu.nz
 
 BNZ = ConditionalMnemonic(
-    operation_microcode_true=(
+    operation_microcode_true=compile_microcode((
         ('er', 'lp'),
-        ),
-    operation_microcode_false=(
+        )),
+    operation_microcode_false=compile_microcode((
         tuple(),
-        ),
+        )),
     low_nibble=0x8,
     addressing_modes=(absolute_branching, indirect_branching),
     mnemonic='BNZ',
@@ -416,10 +732,10 @@ BNZ = ConditionalMnemonic(
     )
 
 STA = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         ('er', 'lm'),
         ('ea', 'lr'),
-        ),
+        )),
     low_nibble=0x5,
     addressing_modes=(absolute_branching, indirect_branching),
     mnemonic='STA'
@@ -427,9 +743,9 @@ STA = Mnemonic(
 
 # Output A register
 OTA = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         ('ea', 'lo'),
-        ),
+        )),
     low_nibble=0x6,
     addressing_modes=(implied,),
     mnemonic='OTA'
@@ -437,36 +753,36 @@ OTA = Mnemonic(
 
 # read Char (8bits) from input to the A register
 BAI = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         ('ec', 'la'),
-        ),
+        )),
     low_nibble=0x7,
     addressing_modes=(implied,),
     mnemonic='BAI'
     )
 
 DMA = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         ('dma',),
-        ),
+        )),
     low_nibble=0xD,
     addressing_modes=(implied,),
     mnemonic='DMA'
     )
 
 NOP = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         tuple(),
-        ),
+        )),
     low_nibble=0xE,
     addressing_modes=(implied,),
     mnemonic='NOP'
     )
 
 HLT = Mnemonic(
-    operation_microcode=(
+    operation_microcode=compile_microcode((
         ('hp',),
-        ),
+        )),
     low_nibble=0xF,
     addressing_modes=(implied,),
     mnemonic='HLT'
@@ -475,14 +791,246 @@ HLT = Mnemonic(
 mnemonics = [LDA, ADD, SUB, OUT, STA, JMP, BNZ, HLT, NOP, DMA, OTA, BAI]
 opcode_map = generate_opcode_map(mnemonics)
 
+def generate_decode_table(opcode_map):
+    """
+    Build a 256 entry table of (test_fxn, (microcode if false, microcode if true))
+
+    test_fxn is None for unconditional opcodes, whose two microcodes are the same.
+    Non-existant opcodes decode to NOP.
+    """
+    table = dict()
+    for opcode, op in opcode_map.items():
+        prefix = fetch_microcode + op.mode.arg_fetch_microcode
+        if isinstance(op.mne, ConditionalMnemonic):
+            table[opcode] = (op.mne.test_fxn, (
+                prefix + op.mne.operation_microcode_false,
+                prefix + op.mne.operation_microcode_true,
+                ))
+        else:
+            microcode = prefix + op.mne.operation_microcode
+            table[opcode] = (None, (microcode, microcode))
+    nop = table[0xFE]
+    return [table.get(opcode, nop) for opcode in range(0xFF + 1)]
+
+decode_table = generate_decode_table(opcode_map)
+
+### Instruction level interpreter ###
+# Each function has the same effect as the microcode of its addressing mode
+# or mnemonic, without putting anything on the bus.
+def _implied(cpu):
+    pass
+
+def _next_memory_loc(cpu):
+    cpu.mar.value = cpu.pc.value
+    cpu.pc.increment()
+
+def _operand_address(cpu):
+    _next_memory_loc(cpu)
+    cpu.mar.value = cpu.ram.read()
+
+def _indirect_operand_address(cpu):
+    _operand_address(cpu)
+    cpu.mar.value = cpu.pc.value
+    cpu.mar.value = cpu.ram.read()
+
+addressing_operations = (
+    (implied, _implied),
+    (immediate, _next_memory_loc),
+    (absolute, _operand_address),
+    (indirect, _indirect_operand_address),
+    (absolute_branching, _next_memory_loc),
+    (indirect_branching, _operand_address),
+    )
+
+def _lda(cpu):
+    cpu.reg_a.latch(cpu.ram.read())
+
+def _add(cpu):
+    cpu.reg_b.latch(cpu.ram.read())
+    cpu.reg_a.latch(cpu.adder.add())
+
+def _sub(cpu):
+    cpu.reg_b.latch(cpu.ram.read())
+    cpu.reg_a.latch(cpu.adder.subtract())
+
+def _out(cpu):
+    cpu.reg_o.display(cpu.ram.read())
+
+def _jmp(cpu):
+    cpu.pc.jump(cpu.ram.read())
+
+def _bnz(cpu):
+    if BNZ.test_fxn(cpu.adder):
+        cpu.pc.jump(cpu.ram.read())
+
+def _sta(cpu):
+    cpu.mar.value = cpu.ram.read()
+    cpu.ram.write(cpu.reg_a.value)
+
+def _ota(cpu):
+    cpu.reg_o.display(cpu.reg_a.value)
+
+def _bai(cpu):
+    cpu.reg_a.latch(cpu.reg_c.read_input())
+
+def _dma(cpu):
+    cpu.dma.transfer()
+
+def _nop(cpu):
+    pass
+
+def _hlt(cpu):
+    cpu.pc.halt()
+
+mnemonic_operations = {
+    'LDA': _lda,
+    'ADD': _add,
+    'SUB': _sub,
+    'OUT': _out,
+    'JMP': _jmp,
+    'BNZ': _bnz,
+    'STA': _sta,
+    'OTA': _ota,
+    'BAI': _bai,
+    'DMA': _dma,
+    'NOP': _nop,
+    'HLT': _hlt,
+    }
+
+def generate_instruction_table(opcode_map):
+    """
+    Build a 256 entry table of (addressing operation, mnemonic operation, T-states)
+    Non-existant opcodes execute NOP, as they do in Clock.decode
+    """
+    table = dict()
+    for opcode, op in opcode_map.items():
+        address_fxn = next(f for adm, f in addressing_operations if adm is op.mode)
+        t_states = len(op.decode())
+        table[opcode] = (address_fxn, mnemonic_operations[op.mne.mnemonic], t_states)
+    nop = table[0xFE]
+    return [table.get(opcode, nop) for opcode in range(0xFF + 1)]
+
+instruction_table = generate_instruction_table(opcode_map)
+
+def execute_instruction(cpu):
+    """Execute one whole instruction on cpu and return the T-states it would take"""
+    _next_memory_loc(cpu)
+    opcode = cpu.ram.read()
+    cpu.reg_i.latch(opcode)
+
+    address_fxn, operation_fxn, t_states = instruction_table[opcode]
+    address_fxn(cpu)
+    operation_fxn(cpu)
+    return t_states
+
+### Predecoded instructions ###
+@dataclass
+class PredecodedInstruction:
+    opcode: int
+    mode: AddressingMode
+    # byte after the opcode, None for implied instructions
+    operand: Optional[int]
+    # (test_fxn, microcodes), see decode_table
+    decoded: Tuple
+    # program counter and memory address register after the operand fetch
+    pc: int
+    mar: int
+    # T-states of the fetch and operand fetch
+    t_states: int
+
+def predecode(memory, address):
+    """Fetch and decode the instruction at address without the bus"""
+    opcode = memory[address]
+    # non-existant opcodes execute NOP, as they do in Clock.decode
+    op = opcode_map.get(opcode, opcode_map[0xFE])
+    pc = (address + 1) % (0xFF + 1)
+    mar = address
+    operand = None
+    # same effect as the arg fetch microcode, see _operand_address
+    if op.mode is not implied:
+        operand = memory[pc]
+        mar = pc
+        pc = (pc + 1) % (0xFF + 1)
+        if op.mode in (absolute, indirect_branching):
+            mar = operand
+        elif op.mode is indirect:
+            # the quirk of the microcode, the address is the byte after the operand
+            mar = memory[pc]
+    return PredecodedInstruction(
+        opcode=opcode,
+        mode=op.mode,
+        operand=operand,
+        decoded=decode_table[opcode],
+        pc=pc,
+        mar=mar,
+        t_states=len(fetch_microcode) + len(op.mode.arg_fetch_microcode),
+        )
+
+class PredecodeCache():
+    """
+    Predecoded instructions of a RandomAccessMemory by address
+
+    Entries are made on the first execution of an address and dropped
+    when a byte they were read from is written, such as the opcode or
+    operand of self-modifying code. A block change of the memory, by
+    load(), restore() or reset(), drops them all.
+    """
+    # an instruction reads its opcode and at most two more bytes
+    SPAN = 3
+
+    def __init__(self, ram):
+        self.ram = ram
+        self.entries = [None] * (0xFF + 1)
+        self._generation = ram.generation
+        self._handle = ram.watch(0x00, 0xFF + 1, self._written, writes_only=True)
+
+    def close(self):
+        """Stop watching the memory"""
+        self.ram.unwatch(self._handle)
+
+    def entry(self, address):
+        if self._generation != self.ram.generation:
+            self.entries = [None] * (0xFF + 1)
+            self._generation = self.ram.generation
+        entry = self.entries[address]
+        if entry is None:
+            entry = predecode(self.ram.memory, address)
+            self.entries[address] = entry
+        return entry
+
+    def _written(self, address, value):
+        for offset in range(self.SPAN):
+            self.entries[(address - offset) % (0xFF + 1)] = None
+
 class Clock():
-    def __init__(self, reg_i=None):
+    def __init__(self, reg_i=None, alu=None):
         self.reg_i = reg_i
+        self.alu = alu
         self.components = []
+        # something with record(cycle, t_state, control_word, data), see sapy.trace
+        self.tracer = None
+        # something with record(address, opcode), see sapy.profiler
+        self.profiler = None
+        # (program counter, memory address register, memory), see connect_fetch
+        self._fetch = None
+        # PredecodeCache of the memory, made on the first direct fetch
+        self._predecoded = None
         self.reset()
 
+    def connect_fetch(self, pc, mar, ram):
+        """
+        Let step() take the fetch and operand fetch of whole instructions
+        from a PredecodeCache of ram instead of the bus. Their T-states
+        are still counted.
+        """
+        if self._predecoded is not None:
+            self._predecoded.close()
+        self._fetch = (pc, mar, ram)
+        self._predecoded = None
+
     def reset(self):
         self.t_state = 0
+        self.cycles = 0
         self.microcode = fetch_microcode
 
         for c in self.components:
@@ -506,54 +1054,188 @@ class Clock():
         elif len(datas) > 1:
             raise RuntimeError("More than one component outputting to the data bus")
 
-    def step(self, instructionwise=False, debug=True):
-        try:
-            control_word = self.microcode[self.t_state]
-        except IndexError:
-            self.t_state = 0
-            self.microcode = fetch_microcode
-            if instructionwise:
-                return
-            control_word = self.microcode[self.t_state]
-
-        data = self.data_bus(control_word)
-        if debug:
-            if self.t_state == 0:
-                print('-' * 42)
-                print(f"PCADDRESS: ${data:02X}")
-            if data is not None:
-                print(f"T{self.t_state}: Data: ${data:02X}, Control Word: {control_word}")
-            else:
-                print(f"T{self.t_state}: Data: None, Control Word: {control_word}")
-
+    def clock_components(self, data, control_word):
         for c in self.components:
             c.clock(data=data, con=control_word)
 
-        if self.t_state == 1 and self.reg_i is not None:
-            self.decode(self.reg_i.value)
+    def step(self, instructionwise=False, debug=True):
+        # nothing needs to see the fetch of a whole, quiet instruction
+        if instructionwise and not debug and self.tracer is None and self._fetch is not None \
+                and self.t_state == 0 and self.microcode is fetch_microcode:
+            self._fetch_instruction()
+
+        # run until back to 0 when instructionwise
+        while True:
+            try:
+                control_word = self.microcode[self.t_state]
+            except IndexError:
+                self.t_state = 0
+                self.microcode = fetch_microcode
+                if instructionwise:
+                    return
+                control_word = self.microcode[self.t_state]
+
+            data = self.data_bus(control_word)
             if debug:
-                print(f"OPCODE: ${self.reg_i.value:02X}, MNE: {opcode_map[self.reg_i.value].mne.mnemonic}")
-
-        self.t_state += 1
+                if self.t_state == 0:
+                    print('-' * 42)
+                    print(f"PCADDRESS: ${data:02X}")
+                if data is not None:
+                    print(f"T{self.t_state}: Data: ${data:02X}, Control Word: {control_names(control_word)}")
+                else:
+                    print(f"T{self.t_state}: Data: None, Control Word: {control_names(control_word)}")
+            if self.tracer is not None:
+                self.tracer.record(self.cycles, self.t_state, control_word, data)
+
+            self.clock_components(data, control_word)
+            self.cycles += 1
+
+            if self.t_state == 1 and self.reg_i is not None:
+                self.decode(self.reg_i.value)
+                if debug:
+                    mne = opcode_map.get(self.reg_i.value, opcode_map[0xFE]).mne.mnemonic
+                    print(f"OPCODE: ${self.reg_i.value:02X}, MNE: {mne}")
+
+            self.t_state += 1
+
+            if not instructionwise:
+                return
 
-        # run until back to 0
-        if instructionwise:
-            self.step(instructionwise=True, debug=debug)
+    def _fetch_instruction(self):
+        # same effect as fetch_microcode and the arg fetch microcode
+        pc, mar, ram = self._fetch
+        if pc.halted:
+            return
+        if self._predecoded is None:
+            self._predecoded = PredecodeCache(ram)
+        address = pc.value
+        entry = self._predecoded.entry(address)
+        pc.value = entry.pc
+        mar.value = entry.mar
+        self.reg_i.value = entry.opcode
+        self.cycles += entry.t_states
+        self.t_state = entry.t_states
+        if self.profiler is not None:
+            self.profiler.record(address, entry.opcode)
+        self._select_microcode(entry.decoded)
 
     def decode(self, opcode):
+        if self.profiler is not None:
+            # the memory address register still holds the address of the opcode
+            self.profiler.record(self._fetch[1].value, opcode)
+        self._select_microcode(decode_table[opcode])
+
+    def _select_microcode(self, decoded):
+        test_fxn, microcodes = decoded
+        if test_fxn is None or self.alu is None:
+            # assume a reset ALU without one
+            self.microcode = microcodes[True]
+        else:
+            self.microcode = microcodes[bool(test_fxn(self.alu))]
+
+class CompiledClock(Clock):
+    """
+    Clock which compiles each control word once into a bus source and the
+    list of sinks latching from the bus, instead of polling every component
+    on every T-state.
+
+    Components opt in by providing compile_data(con) and compile_clock(con),
+    others fall back to their data and clock methods.
+    """
+    def __init__(self, reg_i=None, alu=None):
+        self._compiled = dict()
+        super().__init__(reg_i, alu)
+
+    def add_component(self, component):
+        super().add_component(component)
+        self._compiled.clear()
+
+    def compile(self, control_word):
+        sources = []
+        dynamic_sources = []
+        sinks = []
+        for c in self.components:
+            if hasattr(c, 'compile_data'):
+                source = c.compile_data(control_word)
+                if source is not None:
+                    sources.append(source)
+            else:
+                dynamic_sources.append(lambda c=c: c.data(control_word))
+
+            if hasattr(c, 'compile_clock'):
+                sink = c.compile_clock(control_word)
+                if sink is not None:
+                    sinks.append(sink)
+            else:
+                sinks.append(lambda data, c=c: c.clock(data=data, con=control_word))
+
+        if dynamic_sources:
+            # we can't know ahead of time who drives the bus
+            sources.extend(dynamic_sources)
+            def source():
+                datas = [d for d in (s() for s in sources) if d is not None]
+                if len(datas) > 1:
+                    raise RuntimeError("More than one component outputting to the data bus")
+                return datas[0] if datas else None
+        elif len(sources) > 1:
+            def source():
+                raise RuntimeError("More than one component outputting to the data bus")
+        elif len(sources) == 1:
+            source = sources[0]
+        else:
+            source = None
+
+        compiled = (source, tuple(sinks))
+        self._compiled[control_word] = compiled
+        return compiled
+
+    def data_bus(self, control_word):
         try:
-            new_microcode = opcode_map[opcode].decode()
-        except AttributeError as e:
-            print(e)
-            print("Possibly No reg_i attached")
-            new_microcode = opcode_map[0xFE].decode()
+            source, _ = self._compiled[control_word]
         except KeyError:
-            print("Non-existant opcode encountered, executing NOP instead.")
-            new_microcode = opcode_map[0xFE].decode()
-        self.microcode = new_microcode
+            source, _ = self.compile(control_word)
+
+        if source is None:
+            return None
+        return source()
+
+    def clock_components(self, data, control_word):
+        for sink in self._compiled[control_word][1]:
+            sink(data)
+
+# version, pc, mar, a, b, o, c, i, flags, t_state, microcode, ram fingerprint, cycles;
+# followed by ram
+snapshot_header = struct.Struct('<BhBBBBBBBBBQQ')
+SNAPSHOT_VERSION = 2
+
+# flags byte of a snapshot
+HALTED_FLAG = 1 << 0
+NZ_FLAG = 1 << 1
+ZERO_FLAG = 1 << 2
+CARRY_FLAG = 1 << 3
+
+# which microcode the clock is running
+FETCH_MICROCODE = 0
+DECODED_MICROCODE_FALSE = 1
+DECODED_MICROCODE_TRUE = 2
+
+def state_key(snapshot):
+    """Snapshot without the cycle count, equal for equal machine states"""
+    cycles_offset = snapshot_header.size - 8
+    return snapshot[:cycles_offset] + snapshot[snapshot_header.size:]
+
+# reading input makes the future of a state depend on more than the state
+input_opcodes = frozenset(opcode for opcode, op in opcode_map.items() if op.mne is BAI)
+
+@dataclass
+class RunResult:
+    cycles: int
+    instructions: int
+    # 'halted', 'max_cycles', 'max_instructions' or 'non_terminating'
+    halt_reason: str
 
 class Computer():
-    def __init__(self):
+    def __init__(self, compiled=False):
         self.pc = ProgramCounter()
         self.mar = MemoryAddressRegister()
         self.ram = RandomAccessMemory(self.mar)
@@ -569,8 +1251,14 @@ class Computer():
         self.switches = SwitchBoard(self.ram, self.mar)
         self.dma = DMAReader(self.ram, self.mar)
 
-        clock = Clock(self.reg_i)
+        if compiled:
+            clock = CompiledClock(self.reg_i, self.adder)
+        else:
+            clock = Clock(self.reg_i, self.adder)
         self._clock = clock
+        clock.connect_fetch(self.pc, self.mar, self.ram)
+        # sapy.jit.BlockCompiler, made on the first run in 'jit' mode
+        self._jit = None
 
         clock.add_component(self.pc)
         clock.add_component(self.mar)
@@ -592,3 +1280,224 @@ class Computer():
     def step(self, *args, **kwargs):
         self._clock.step(*args, **kwargs)
 
+    def snapshot(self):
+        """
+        Capture the whole machine state as a compact, immutable bytes blob
+
+        RAM is copied once into the blob, which can be restored any number
+        of times or written to disk as a checkpoint.
+        """
+        clock = self._clock
+        header = snapshot_header.pack(
+            SNAPSHOT_VERSION,
+            self.pc.value,
+            self.mar.value,
+            self.reg_a.value,
+            self.reg_b.value,
+            self.reg_o.value,
+            self.reg_c.value,
+            self.reg_i.value,
+            self._flags(),
+            clock.t_state,
+            self._microcode_kind(),
+            self.ram.fingerprint,
+            clock.cycles,
+            )
+        return header + self.ram.memory
+
+    def _flags(self):
+        return (HALTED_FLAG * self.pc.halted
+            | NZ_FLAG * self.adder.nz
+            | ZERO_FLAG * self.adder.zero
+            | CARRY_FLAG * self.adder.carry)
+
+    def _microcode_kind(self):
+        microcode = self._clock.microcode
+        if microcode is fetch_microcode:
+            return FETCH_MICROCODE
+        elif microcode is decode_table[self.reg_i.value][1][False]:
+            return DECODED_MICROCODE_FALSE
+        elif microcode is decode_table[self.reg_i.value][1][True]:
+            return DECODED_MICROCODE_TRUE
+        else:
+            raise ValueError("Clock is running microcode not decoded from the instruction register")
+
+    def fingerprint(self):
+        """
+        64 bit hash of the machine state in O(1), equal for equal states
+        whatever the cycle count
+        """
+        return hash((
+            self.ram.fingerprint,
+            self.pc.value,
+            self.mar.value,
+            self.reg_a.value,
+            self.reg_b.value,
+            self.reg_o.value,
+            self.reg_c.value,
+            self.reg_i.value,
+            self._flags(),
+            self._clock.t_state,
+            self._microcode_kind(),
+            ))
+
+    def state_key(self):
+        """Machine state as bytes, equal for equal states whatever the cycle count"""
+        return state_key(self.snapshot())
+
+    def restore(self, snapshot):
+        """Put the machine back into the state captured by snapshot()"""
+        (version, pc, mar, reg_a, reg_b, reg_o, reg_c, reg_i,
+            flags, t_state, microcode, fingerprint, cycles) = snapshot_header.unpack_from(snapshot)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}")
+
+        self.pc.value = pc
+        self.mar.value = mar
+        self.reg_a.value = reg_a
+        self.reg_b.value = reg_b
+        self.reg_o.value = reg_o
+        self.reg_c.value = reg_c
+        self.reg_i.value = reg_i
+        self.pc.halted = bool(flags & HALTED_FLAG)
+        self.adder.nz = bool(flags & NZ_FLAG)
+        self.adder.zero = bool(flags & ZERO_FLAG)
+        self.adder.carry = bool(flags & CARRY_FLAG)
+
+        clock = self._clock
+        clock.t_state = t_state
+        clock.cycles = cycles
+        if microcode == FETCH_MICROCODE:
+            clock.microcode = fetch_microcode
+        else:
+            clock.microcode = decode_table[reg_i][1][microcode == DECODED_MICROCODE_TRUE]
+
+        self.ram.restore(memoryview(snapshot)[snapshot_header.size:], fingerprint)
+
+    def attach_tracer(self, tracer):
+        """Record every T-state into tracer, None detaches it"""
+        if tracer is not None:
+            tracer.connect(self.pc, self.reg_i)
+        self._clock.tracer = tracer
+
+    def attach_profiler(self, profiler):
+        """Count every instruction executed in profiler, None detaches it"""
+        self._clock.profiler = profiler
+
+    def run(self, mode='microcode', max_cycles=None, max_instructions=None, detect_loops=False):
+        """
+        Run until the program counter halts or a budget is used up
+
+        mode
+            'microcode' steps every T-state through the clock,
+            'instruction' executes whole instructions at once,
+            'jit' runs basic blocks compiled to Python by sapy.jit,
+            or single instructions while a profiler is attached.
+            Both step the clock while a tracer is attached.
+            All leave the computer in the same state and count the same T-states.
+        max_cycles
+            Don't start another instruction after this many T-states
+        max_instructions
+            Don't start another instruction after this many instructions
+        detect_loops
+            Stop once the state at an instruction boundary repeats
+            exactly, which shows the program never halts. A single saved
+            state is compared by fingerprint, as in Brent's algorithm, so
+            the loop is found within a few times its length in constant
+            memory. Reading input starts over, as the program may go on
+            differently.
+        """
+        clock = self._clock
+        start_cycles = clock.cycles
+        instructions = 0
+
+        if mode == 'jit' and (detect_loops or clock.profiler is not None):
+            # loops are detected and instructions profiled one at a time
+            mode = 'instruction'
+        if mode in ('instruction', 'jit') and clock.tracer is not None:
+            # only the clock can feed the tracer
+            mode = 'microcode'
+
+        # each step returns the number of instructions it executed
+        if mode == 'microcode':
+            def step():
+                clock.step(instructionwise=True, debug=False)
+                return 1
+        elif mode == 'instruction' and clock.profiler is not None:
+            profiler = clock.profiler
+            def step():
+                profiler.record(self.pc.value, self.ram.values[self.pc.value])
+                clock.cycles += execute_instruction(self)
+                return 1
+        elif mode == 'instruction':
+            def step():
+                clock.cycles += execute_instruction(self)
+                return 1
+        elif mode == 'jit':
+            if self._jit is None:
+                from sapy.jit import BlockCompiler
+                self._jit = BlockCompiler(self.ram)
+            jit = self._jit
+            def step():
+                block = jit.block(self.pc.value)
+                # how often the block can run within the budgets
+                limit = None
+                if max_cycles is not None:
+                    limit = (max_cycles - (clock.cycles - start_cycles)) // block.cycles
+                if max_instructions is not None:
+                    remaining = (max_instructions - instructions) // block.instructions
+                    limit = remaining if limit is None else min(limit, remaining)
+
+                if limit == 0:
+                    # the block would overrun a budget, finish one instruction at a time
+                    clock.cycles += execute_instruction(self)
+                    executed = 1
+                else:
+                    runs = block.function(self, limit)
+                    clock.cycles += runs * block.cycles
+                    executed = runs * block.instructions
+                return executed
+        else:
+            raise ValueError(f"Unknown run mode \"{mode}\"")
+
+        if clock.t_state != 0 and not self.pc.halted:
+            # finish the instruction in progress
+            clock.step(instructionwise=True, debug=False)
+            instructions += clock.cycles != start_cycles
+
+        # Brent's cycle detection: a saved state, moved to the current one
+        # after 1, 2, 4, ... instructions, is compared with every state after it
+        saved = None
+        power = 1
+        since_saved = 0
+        while True:
+            if self.pc.halted:
+                halt_reason = 'halted'
+                break
+            if max_cycles is not None and clock.cycles - start_cycles >= max_cycles:
+                halt_reason = 'max_cycles'
+                break
+            if max_instructions is not None and instructions >= max_instructions:
+                halt_reason = 'max_instructions'
+                break
+            if detect_loops:
+                if self.ram.values[self.pc.value] in input_opcodes:
+                    saved = None
+                fingerprint = self.fingerprint()
+                # the fingerprint finds a repeat, the state key rules out collisions
+                if saved is not None and fingerprint == saved[0] and self.state_key() == saved[1]:
+                    halt_reason = 'non_terminating'
+                    break
+                if saved is None or since_saved == power:
+                    power = 1 if saved is None else 2 * power
+                    saved = (fingerprint, self.state_key())
+                    since_saved = 0
+                since_saved += 1
+
+            instructions += step()
+
+        return RunResult(
+            cycles=clock.cycles - start_cycles,
+            instructions=instructions,
+            halt_reason=halt_reason,
+            )
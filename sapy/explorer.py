@@ -0,0 +1,121 @@
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from sapy.components import Computer, opcode_map, input_opcodes
+
+# opcodes at which the explorer deduplicates, besides forking at input_opcodes
+branch_opcodes = {opcode for opcode, op in opcode_map.items() if op.mne.mnemonic in ('BNZ', 'JMP')}
+
+@dataclass
+class ExploredPath:
+    inputs: Tuple[int, ...]
+    outputs: bytes
+    instructions: int
+    # 'halted', 'max_instructions' or 'non_terminating'
+    halt_reason: str
+    snapshot: bytes
+
+class Explorer():
+    """
+    Explore every path through a program for all values its BAI
+    instructions can read
+
+    The machine state is forked at each input read, one branch per input
+    value. States reached at forks and branches are remembered. A path
+    reaching a state earlier in its own history loops and is reported as
+    non_terminating, a path reaching a state another path already reached
+    is dropped, as it has the same future.
+    """
+    def __init__(self, program, input_values=range(0xFF + 1), max_instructions=10_000):
+        self.input_values = tuple(input_values)
+        self.max_instructions = max_instructions
+
+        self._cpu = Computer()
+        self._outputs = bytearray()
+        self._cpu.reg_o.output_function = self._outputs.append
+        self._cpu.dma.connect_dma_handler(None)
+        self._cpu.switches.load_program(program)
+        self._start = self._cpu.snapshot()
+
+    def explore(self) -> List[ExploredPath]:
+        cpu = self._cpu
+        # (state key, segment of the path first reaching it) by fingerprint
+        self.visited = dict()
+        self.merged = 0 # paths dropped for reaching a state another path reached
+        # the segment each segment was forked from, paths are split into
+        # segments at input reads
+        self._parents = [None]
+        paths = []
+
+        # (snapshot, inputs, outputs, instructions, segment)
+        work = [(self._start, (), b'', 0, 0)]
+        while work:
+            snapshot, inputs, outputs, instructions, segment = work.pop()
+            cpu.restore(snapshot)
+            self._outputs[:] = outputs
+
+            while True:
+                if cpu.pc.halted or instructions >= self.max_instructions:
+                    paths.append(self._path(inputs, instructions, 'halted' if cpu.pc.halted else 'max_instructions'))
+                    break
+
+                opcode = cpu.ram.values[cpu.pc.value]
+                if opcode in input_opcodes:
+                    self._fork(work, paths, inputs, instructions, segment)
+                    break
+
+                if opcode in branch_opcodes and not self._visit(paths, inputs, instructions, segment):
+                    break
+
+                instructions += cpu.run(mode='instruction', max_instructions=1).instructions
+
+        return paths
+
+    def _path(self, inputs, instructions, halt_reason):
+        return ExploredPath(
+            inputs=inputs,
+            outputs=bytes(self._outputs),
+            instructions=instructions,
+            halt_reason=halt_reason,
+            snapshot=self._cpu.snapshot(),
+            )
+
+    def _visit(self, paths, inputs, instructions, segment):
+        """
+        Remember the current state, False if it was seen before, then the
+        path ends as non_terminating or merged
+        """
+        cpu = self._cpu
+        state = cpu.state_key()
+        # a matching fingerprint only finds candidates, the state key decides
+        candidates = self.visited.setdefault(cpu.fingerprint(), [])
+        first = next((seen_by for key, seen_by in candidates if key == state), None)
+        if first is None:
+            candidates.append((state, segment))
+            return True
+        if self._is_ancestor(first, segment):
+            paths.append(self._path(inputs, instructions, 'non_terminating'))
+        else:
+            self.merged += 1
+        return False
+
+    def _fork(self, work, paths, inputs, instructions, segment):
+        cpu = self._cpu
+        snapshot = cpu.snapshot()
+        outputs = bytes(self._outputs)
+        # explore in the order of input_values
+        for value in reversed(self.input_values):
+            cpu.restore(snapshot)
+            cpu.reg_c.input_function = lambda: value
+            cpu.run(mode='instruction', max_instructions=1)
+            child = len(self._parents)
+            self._parents.append(segment)
+            if self._visit(paths, inputs + (value,), instructions + 1, child):
+                work.append((cpu.snapshot(), inputs + (value,), outputs, instructions + 1, child))
+
+    def _is_ancestor(self, ancestor, segment):
+        while segment is not None:
+            if segment == ancestor:
+                return True
+            segment = self._parents[segment]
+        return False
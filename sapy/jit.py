@@ -0,0 +1,206 @@
+import functools
+
+from dataclasses import dataclass
+from typing import Callable, Tuple
+
+from sapy.components import opcode_map, instruction_table, execute_instruction, \
+    implied, immediate, absolute, indirect, absolute_branching, indirect_branching
+
+# mnemonics compiled into the body of a block, any other instruction ends it
+straight_line_mnemonics = ('LDA', 'ADD', 'SUB', 'NOP')
+# instructions ending a block that are compiled too
+branch_mnemonics = ('JMP', 'BNZ', 'HLT')
+MAX_BLOCK_INSTRUCTIONS = 64
+
+@dataclass
+class Block:
+    function: Callable
+    start: int
+    # addresses of the code bytes the block was compiled from
+    addresses: Tuple[int, ...]
+    cycles: int
+    instructions: int
+    source: str
+
+def compile_block(memory, start):
+    """
+    Compile the basic block of memory starting at address start
+
+    The body, straight line LDA/ADD/SUB/NOP instructions, becomes Python
+    working on local registers, as does a JMP, BNZ or HLT ending the block.
+    Opcodes and operands are read once at compile time, the data they
+    address at run time. Any other instruction ending the block, a store
+    or I/O, is executed by execute_instruction after the registers are
+    written back.
+
+    The function takes the computer and a limit and returns how often the
+    block ran. A block branching back to its own start loops inside the
+    function until it falls through or has run limit times, None for no limit.
+    """
+    body = []
+    address = start
+    while len(body) < MAX_BLOCK_INSTRUCTIONS:
+        opcode = memory[address]
+        # non-existant opcodes execute NOP, as they do in Clock.decode
+        op = opcode_map.get(opcode, opcode_map[0xFE])
+        body.append((address, opcode, op))
+        address = (address + 1 + (op.mode is not implied)) % (0xFF + 1)
+        if op.mne.mnemonic not in straight_line_mnemonics:
+            break
+    end = address
+
+    alu_ops = [address for address, opcode, op in body if op.mne.mnemonic in ('ADD', 'SUB')]
+    last_alu = alu_ops[-1] if alu_ops else None
+
+    lines = []
+    addresses = []
+    cycles = 0
+    pc = f"{end:#04x}"
+    loops = False
+    executed = None
+    for address, opcode, op in body:
+        addresses.append(address)
+        cycles += instruction_table[opcode][2]
+        mnemonic = op.mne.mnemonic
+        if mnemonic not in straight_line_mnemonics + branch_mnemonics:
+            # leave the instruction to the interpreter
+            executed = address
+            break
+
+        operand = (address + 1) % (0xFF + 1)
+        following = (operand + 1) % (0xFF + 1)
+        opcode_loaded = opcode
+
+        # same effect as the addressing operation, see _operand_address
+        if op.mode is implied:
+            mar = f"{address:#04x}"
+            value = None
+        elif op.mode in (immediate, absolute_branching):
+            addresses.append(operand)
+            mar = f"{operand:#04x}"
+            value = f"{memory[operand]:#04x}"
+        elif op.mode in (absolute, indirect_branching):
+            addresses.append(operand)
+            mar = f"{memory[operand]:#04x}"
+            value = f"ram[{mar}]"
+        elif op.mode is indirect:
+            addresses.append(operand)
+            # the quirk of the microcode, the address is the byte after the operand
+            lines.append(f"mar = ram[{following:#04x}]")
+            mar = "mar"
+            value = "ram[mar]"
+
+        if mnemonic == 'LDA':
+            lines.append(f"a = {value}")
+        elif mnemonic in ('ADD', 'SUB'):
+            lines.append(f"b = {value}")
+            lines.append(f"t = a {'+' if mnemonic == 'ADD' else '-'} b")
+            lines.append("a = t & 0xFF")
+            if address == last_alu:
+                lines.append("zero = a == 0")
+                lines.append("carry = t != a")
+        elif mnemonic == 'JMP':
+            pc = value
+            loops = op.mode is absolute_branching and memory[operand] == start
+            if loops:
+                lines.append("if n == limit: break")
+        elif mnemonic == 'BNZ':
+            nz = "not zero" if alu_ops else "cpu.adder.nz"
+            loops = op.mode is absolute_branching and memory[operand] == start
+            if loops:
+                lines.append(f"if not {nz} or n == limit: break")
+            pc = f"({value} if {nz} else {end:#04x})"
+        elif mnemonic == 'HLT':
+            # move back to the halt instruction
+            pc = f"{(address + 1) % (0xFF + 1) - 1:#04x}"
+            lines.append("cpu.pc.halted = True")
+
+    if loops:
+        lines = ["n += 1"] + lines
+        lines = ["n = 0", "while True:"] + [f"    {line}" for line in lines]
+    lines = ["ram = cpu.ram.memory", "a = cpu.reg_a.value"] + lines
+
+    if executed is not None:
+        # the interpreter fetches the instruction again
+        pc = f"{executed:#04x}"
+    if executed != start:
+        lines.append(f"cpu.pc.value = {pc}")
+        lines.append(f"cpu.mar.value = {mar}")
+        lines.append(f"cpu.reg_i.value = {opcode_loaded:#04x}")
+        lines.append("cpu.reg_a.value = a")
+    if alu_ops:
+        lines.append("cpu.reg_b.value = b")
+        lines.append("cpu.adder.zero = zero")
+        lines.append("cpu.adder.nz = not zero")
+        lines.append("cpu.adder.carry = carry")
+    if executed is not None:
+        lines.append("execute(cpu)")
+    lines.append("return n" if loops else "return 1")
+
+    source = "def block(cpu, limit=None):\n" + "".join(f"    {line}\n" for line in lines)
+    return Block(
+        function=_compile_function(source),
+        start=start,
+        addresses=tuple(addresses),
+        cycles=cycles,
+        instructions=len(body),
+        source=source,
+        )
+
+# the same code compiles to the same source, share its function
+@functools.lru_cache(maxsize=4096)
+def _compile_function(source):
+    namespace = {'execute': execute_instruction}
+    exec(compile(source, "<block>", 'exec'), namespace)
+    return namespace['block']
+
+class BlockCompiler():
+    """
+    Cache of compiled blocks of a RandomAccessMemory by start address
+
+    Each block watches the memory it was compiled from and is dropped
+    when that is written, as self-modifying code does through STA.
+    """
+    def __init__(self, ram):
+        self.ram = ram
+        self.blocks = dict()
+        # watch handles of each block
+        self._handles = dict()
+        # start addresses of the blocks with code at each address
+        self._owners = [set() for _ in range(0xFF + 1)]
+
+    def flush(self):
+        for start in tuple(self.blocks):
+            self._drop(start)
+
+    def block(self, start):
+        try:
+            return self.blocks[start]
+        except KeyError:
+            block = compile_block(self.ram.memory, start)
+            self.blocks[start] = block
+            for address in block.addresses:
+                self._owners[address].add(start)
+            self._handles[start] = [self.ram.watch(first, stop, self._written)
+                for first, stop in _ranges(block.addresses)]
+            return block
+
+    def _written(self, address, value):
+        for start in tuple(self._owners[address]):
+            self._drop(start)
+
+    def _drop(self, start):
+        for address in self.blocks.pop(start).addresses:
+            self._owners[address].discard(start)
+        for handle in self._handles.pop(start):
+            self.ram.unwatch(handle)
+
+def _ranges(addresses):
+    """Contiguous (start, stop) ranges covering addresses"""
+    ranges = []
+    for address in sorted(set(addresses)):
+        if ranges and ranges[-1][1] == address:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([address, address + 1])
+    return [tuple(r) for r in ranges]
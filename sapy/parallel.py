@@ -0,0 +1,117 @@
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List
+
+from sapy.components import Computer, snapshot_header
+from sapy.assembler import assemble_lines
+
+# change whenever the fields of ProgramResult change, see sapy.cache
+RESULT_FORMAT = 2
+
+@dataclass
+class ProgramResult:
+    outputs: bytes
+    cycles: int
+    instructions: int
+    halt_reason: str
+    # final machine state, see Computer.snapshot
+    snapshot: bytes
+
+    @property
+    def ram(self):
+        # the snapshot ends in the memory, so it is pickled once
+        return self.snapshot[snapshot_header.size:]
+
+def program_bytes(program):
+    """Bytecode of program, assembling it if it is source"""
+    if isinstance(program, str):
+        return bytes(assemble_lines(program.splitlines()))
+    return bytes(program)
+
+def run_program(program, inputs=(), max_cycles=None, max_instructions=None):
+    """
+    Run a single program on a fresh, silent Computer
+
+    program
+        bytes, a list of ints, or assembly source
+    inputs
+        values returned to BAI in order, running out raises RuntimeError
+    """
+    cpu = Computer()
+    outputs = bytearray()
+    cpu.reg_o.output_function = outputs.append
+    values = iter(inputs)
+    def input_function():
+        try:
+            return next(values)
+        except StopIteration:
+            raise RuntimeError("Program ran out of input") from None
+    cpu.reg_c.input_function = input_function
+    cpu.dma.connect_dma_handler(None)
+
+    cpu.switches.load_program(program_bytes(program))
+    result = cpu.run(mode='instruction', max_cycles=max_cycles, max_instructions=max_instructions)
+    return ProgramResult(
+        outputs=bytes(outputs),
+        cycles=result.cycles,
+        instructions=result.instructions,
+        halt_reason=result.halt_reason,
+        snapshot=cpu.snapshot(),
+        )
+
+def _run_program(args):
+    return run_program(*args)
+
+def run_many(programs, workers=None, inputs=None, max_cycles=None, max_instructions=None,
+        cache=None) -> List[ProgramResult]:
+    """
+    Run each program on its own Computer spread over a process pool,
+    results are returned in the order of programs.
+
+    workers
+        number of processes, os.cpu_count() by default, 1 runs in this process
+    inputs
+        a sequence of BAI input values for each program
+    cache
+        a ResultCache, only programs it has no result for are run
+    """
+    if inputs is None:
+        inputs = [()] * len(programs)
+    assert len(inputs) == len(programs), "Need one input sequence per program"
+
+    if cache is not None:
+        programs = [program_bytes(program) for program in programs]
+    jobs = [(program, tuple(values), max_cycles, max_instructions)
+        for program, values in zip(programs, inputs)]
+
+    if cache is None:
+        return _run_jobs(jobs, workers)
+
+    keys = [cache.key(*job) for job in jobs]
+    # each job missing from the cache is run once, however often it repeats
+    found = dict()
+    missing = dict()
+    for key, job in zip(keys, jobs):
+        if key not in found and key not in missing:
+            result = cache.get(key)
+            if result is None:
+                missing[key] = job
+            else:
+                found[key] = result
+    for key, result in zip(missing, _run_jobs(list(missing.values()), workers)):
+        cache.put(key, result)
+        found[key] = result
+    return [found[key] for key in keys]
+
+def _run_jobs(jobs, workers):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(jobs) <= 1:
+        return [_run_program(job) for job in jobs]
+
+    # hand out work in chunks so each process pickles few, large batches
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_run_program, jobs, chunksize=chunksize))
@@ -0,0 +1,90 @@
+from collections import Counter
+
+from sapy.components import opcode_map, instruction_table, \
+    implied, immediate, absolute, indirect, absolute_branching, indirect_branching
+from sapy.assembler import assemble_lines
+
+addressing_mode_names = (
+    (implied, 'implied'),
+    (immediate, 'immediate'),
+    (absolute, 'absolute'),
+    (indirect, 'indirect'),
+    (absolute_branching, 'absolute_branching'),
+    (indirect_branching, 'indirect_branching'),
+    )
+
+def describe_opcode(opcode):
+    """(mnemonic, addressing mode name) opcode executes as"""
+    # non-existant opcodes execute NOP, as they do in Clock.decode
+    op = opcode_map.get(opcode, opcode_map[0xFE])
+    mode = next(name for adm, name in addressing_mode_names if adm is op.mode)
+    return op.mne.mnemonic, mode
+
+def source_map(assembly_text):
+    """Map the address of each instruction in assembly_text to (source, label)"""
+    bytecode, listing = assemble_lines(assembly_text.splitlines(), listing=True)
+    return {line.address: (line.source, line.label) for line in listing}
+
+class Profiler():
+    """
+    Counts the instructions executed at each address
+
+    T-states follow from the opcode, so only (address, opcode) pairs are
+    counted, which keeps recording cheap. Attach with Computer.attach_profiler.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = Counter()
+
+    def record(self, address, opcode):
+        self.counts[address, opcode] += 1
+
+    @property
+    def instructions(self):
+        return sum(self.counts.values())
+
+    @property
+    def t_states(self):
+        return sum(count * instruction_table[opcode][2] for (address, opcode), count in self.counts.items())
+
+    def by_address(self):
+        """{address: (instructions, T-states)}"""
+        return self._histogram(lambda address, opcode: address)
+
+    def by_mnemonic(self):
+        """{(mnemonic, addressing mode name): (instructions, T-states)}"""
+        return self._histogram(lambda address, opcode: describe_opcode(opcode))
+
+    def _histogram(self, key_fxn):
+        instructions = Counter()
+        t_states = Counter()
+        for (address, opcode), count in self.counts.items():
+            key = key_fxn(address, opcode)
+            instructions[key] += count
+            t_states[key] += count * instruction_table[opcode][2]
+        return {key: (instructions[key], t_states[key]) for key in instructions}
+
+    def report(self, assembly_text=None, top=10):
+        """
+        Hot spots as text, the top addresses and mnemonics by T-states
+
+        Addresses are shown with their source line and label when the
+        program's assembly_text is given.
+        """
+        lines = source_map(assembly_text) if assembly_text is not None else dict()
+        total = self.t_states or 1
+
+        report = [f"{'ADDR':6}{'LABEL':12}{'SOURCE':16}{'COUNT':>10}{'T-STATES':>10}{'%':>7}"]
+        hot = sorted(self.by_address().items(), key=lambda item: item[1][1], reverse=True)
+        for address, (count, t_states) in hot[:top]:
+            source, label = lines.get(address, ('', ''))
+            report.append(f"0x{address:02X}  {label:12}{source:16}{count:10}{t_states:10}{100 * t_states / total:7.1f}")
+
+        report.append('')
+        report.append(f"{'MNEMONIC':10}{'MODE':24}{'COUNT':>10}{'T-STATES':>10}{'%':>7}")
+        hot = sorted(self.by_mnemonic().items(), key=lambda item: item[1][1], reverse=True)
+        for (mnemonic, mode), (count, t_states) in hot[:top]:
+            report.append(f"{mnemonic:10}{mode:24}{count:10}{t_states:10}{100 * t_states / total:7.1f}")
+        return '\n'.join(report)
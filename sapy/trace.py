@@ -0,0 +1,58 @@
+import numpy as np # type: ignore
+
+from sapy.components import encode_control
+
+trace_dtype = np.dtype([
+    ('cycle', np.uint64),
+    ('t_state', np.uint8),
+    ('pc', np.int16),
+    ('opcode', np.uint8),
+    ('control_word', np.uint64),
+    ('bus', np.int16), # -1 when nothing drives the bus
+    ])
+
+class Tracer():
+    """
+    Records every T-state the clock executes into a ring buffer
+
+    Each record holds the cycle, T-state, program counter and opcode at the
+    start of the T-state, the control word and the value on the bus.
+    Only the last depth records are kept.
+    """
+    def __init__(self, depth=1 << 16):
+        self.depth = depth
+        self.buffer = np.zeros(depth, dtype=trace_dtype)
+        self._pc = None
+        self._reg_i = None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+
+    def connect(self, pc, reg_i):
+        self._pc = pc
+        self._reg_i = reg_i
+
+    def record(self, cycle, t_state, control_word, data):
+        pc = self._pc.value if self._pc is not None else -1
+        opcode = self._reg_i.value if self._reg_i is not None else 0
+        if data is None:
+            data = -1
+        self.buffer[self.count % self.depth] = (
+            cycle, t_state, pc, opcode, encode_control(control_word), data)
+        self.count += 1
+
+    @property
+    def dropped(self):
+        """Number of records overwritten since the last reset"""
+        return max(0, self.count - self.depth)
+
+    def __len__(self):
+        return min(self.count, self.depth)
+
+    def records(self):
+        """Copy of the kept records, oldest first"""
+        if self.count <= self.depth:
+            return self.buffer[:self.count].copy()
+        start = self.count % self.depth
+        return np.concatenate((self.buffer[start:], self.buffer[:start]))
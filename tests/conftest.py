@@ -0,0 +1,47 @@
+import pytest # type: ignore
+
+from sapy.components import Computer
+
+# counts down from 3, outputting 2, 1 and 0
+COUNTDOWN_SOURCE = """
+        LDA #$03
+    loop:
+        SUB #$01
+        OTA
+        BNZ loop
+        HLT
+"""
+
+def countdown_program(start=0x03):
+    """Bytecode of COUNTDOWN_SOURCE counting down from start"""
+    return [
+        0x20, start, # 0x00 LDA #start
+        0x22, 0x01,  # 0x02 SUB #$01
+        0xF6,        # 0x04 OTA
+        0x38, 0x02,  # 0x05 BNZ $02
+        0xFF,        # 0x07 HLT
+        ]
+
+def make_silent_computer(program, compiled=False, outputs=None):
+    """
+    Computer with program loaded that prints nothing, appends what it
+    outputs to outputs, reads 0x42 from input and ignores DMA
+    """
+    cpu = Computer(compiled=compiled)
+    cpu.reg_o.output_function = (lambda x: None) if outputs is None else outputs.append
+    cpu.reg_c.input_function = lambda: 0x42
+    cpu.dma.connect_dma_handler(None)
+    cpu.switches.load_program(program)
+    return cpu
+
+@pytest.fixture
+def countdown_source():
+    return COUNTDOWN_SOURCE
+
+@pytest.fixture
+def countdown():
+    return countdown_program
+
+@pytest.fixture
+def silent_computer():
+    return make_silent_computer
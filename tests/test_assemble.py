@@ -1,6 +1,10 @@
+import io
+
 import pytest
 
-from sapy.assembler import MNEMONIC as M, translate_instruction, assemble
+from sapy import assembler
+from sapy.assembler import MNEMONIC as M, translate_instruction, assemble, assemble_lines, ListingLine, generate_syntax_table, AssemblerSession, translate_line
+from sapy.components import Computer, Mnemonic, generate_opcode_map, opcode_map, absolute, absolute_branching
 
 def test_implied():
     bytecode = translate_instruction('HLT')
@@ -114,3 +118,260 @@ def test_lable_defined_after_use():
     assert bytecode == [0x10, 0xC2, 0x44, 0x06, 0x10, 0xC2,]
 
 # def test_missing_opcode_arg_raises()
+
+def test_assemble_lines_reads_files_silently(capsys):
+    source = io.StringIO("""
+        LDA ($C2)
+        back:
+        JMP back ; loop
+    """)
+    bytecode = assemble_lines(source)
+    assert bytecode == [0x10, 0xC2, 0x34, 0x02]
+    assert capsys.readouterr().out == ''
+
+def test_assemble_lines_lists_instructions():
+    bytecode, listing = assemble_lines(["LDA ($C2)", "back:", "JMP back", "BYTE #01 02"], listing=True)
+    assert listing == [
+        ListingLine(address=0x00, bytecode=[0x10, 0xC2], source="LDA ($C2)", label=''),
+        ListingLine(address=0x02, bytecode=[0x34, 0x02], source="JMP back", label='back'),
+        ListingLine(address=0x04, bytecode=[0x01, 0x02], source="BYTE #01 02", label=''),
+        ]
+
+def test_assemble_prints_listing(capsys):
+    assemble("back:\nJMP back\nHLT")
+    assert capsys.readouterr().out == (
+        "0x00  34 00   # JMP back   :back\n"
+        "0x02  FF      # HLT\n")
+
+def test_listing_separates_long_sources_from_labels(capsys):
+    assemble("start:\nLDA #location\nlocation:\nHLT")
+    assert capsys.readouterr().out.splitlines()[0] == "0x00  20 02   # LDA #location :start"
+
+def test_labels_are_not_matched_inside_other_words():
+    code = """
+        A:
+        LDA A
+        LDA #A
+        B:
+        JMP (B)
+    """
+    bytecode = assemble_lines(code.splitlines())
+    assert bytecode == [0x00, 0x00, 0x20, 0x00, 0x44, 0x04]
+
+def test_label_defined_after_use_with_byte_data():
+    code = """
+        LDA value
+        HLT
+        value:
+        BYTE #2A
+    """
+    bytecode = assemble_lines(code.splitlines())
+    assert bytecode == [0x00, 0x03, 0xFF, 0x2A]
+
+def test_undefined_label_raises():
+    with pytest.raises(RuntimeError):
+        assemble_lines(["JMP nowhere"])
+
+def test_label_defined_twice_raises():
+    with pytest.raises(RuntimeError):
+        assemble_lines(["back:", "NOP", "back:", "JMP back"])
+
+def test_syntax_table_covers_opcode_map():
+    table = generate_syntax_table(opcode_map)
+    assert len(table) == len(opcode_map)
+    assert table['LDA', '#'] == 0x20
+    assert table['JMP', '()'] == 0x44
+    assert table['HLT', ''] == 0xFF
+
+def test_syntax_table_rejects_ambiguous_mnemonics():
+    lda = M['LDA']
+    ambiguous = Mnemonic(lda.operation_microcode, lda.low_nibble, (absolute, absolute_branching), 'LDA')
+    with pytest.raises(AssertionError):
+        generate_syntax_table(generate_opcode_map([ambiguous]))
+
+@pytest.mark.parametrize("instruction", ["HLT $05", "JMP #$05", "LDA", "LDA ($05", "LDA #$100", "LDA $05 $06"])
+def test_bad_operand_syntax_raises(instruction):
+    with pytest.raises(RuntimeError):
+        translate_instruction(instruction)
+
+@pytest.fixture
+def countdown_lines(countdown_source):
+    return countdown_source.splitlines()
+
+def test_session_matches_assemble_lines(countdown_lines):
+    session = AssemblerSession(countdown_lines)
+    assert session.bytecode == assemble_lines(countdown_lines)
+    assert session.labels == {'loop': 0x02}
+
+def test_session_patches_running_memory(countdown_lines):
+    session = AssemblerSession(countdown_lines)
+    cpu = Computer()
+    cpu.switches.load_program(session.bytecode)
+
+    edited = countdown_lines[:2] + ["        NOP"] + countdown_lines[2:] # moves the loop label
+    patch = session.update(edited)
+    assert patch == [(0x02, bytes([0xFE, 0x22, 0x01, 0xF6, 0x38, 0x03, 0xFF]))]
+    cpu.switches.load_patch(patch)
+    assert bytes(cpu.ram.values[:len(session.bytecode)]) == bytes(assemble_lines(edited))
+
+    patch = session.update(countdown_lines[:-1]) # drop HLT
+    cpu.switches.load_patch(patch)
+    assert bytes(cpu.ram.values[:0x10]) == bytes(assemble_lines(countdown_lines[:-1])).ljust(0x10, b'\x00')
+
+def test_session_translates_only_edited_lines(monkeypatch, countdown_lines):
+    session = AssemblerSession(countdown_lines)
+    translated = []
+    monkeypatch.setattr(assembler, 'translate_line', lambda line: translated.append(line) or translate_line(line))
+    session.update(countdown_lines[:3] + ["        SUB #$02"] + countdown_lines[4:])
+    assert translated == ["        SUB #$02"]
+
+def test_session_keeps_state_after_a_bad_edit(countdown_lines):
+    session = AssemblerSession(countdown_lines)
+    with pytest.raises(RuntimeError):
+        session.edit(2, 3, ["    elsewhere:"]) # BNZ loop is undefined now
+    assert session.lines == countdown_lines
+    assert session.update(countdown_lines) == []
+
+def test_session_expands_macros(countdown_lines):
+    source = """
+        MACRO down step
+            SUB #step
+            OTA
+        ENDM
+        LDA #$06
+    loop:
+        down 2
+        BNZ loop
+        HLT
+    """.splitlines()
+    session = AssemblerSession(source)
+    assert session.bytecode == assemble_lines(source)
+
+    edited = [line.replace('SUB #step', 'SUB #step/2') for line in source]
+    patch = session.update(edited)
+    assert patch == [(0x03, bytes([0x01]))]
+    assert session.bytecode == assemble_lines(edited)
+
+    # without macros the session is incremental again
+    session.update(countdown_lines)
+    assert session.bytecode == assemble_lines(countdown_lines)
+
+def test_equ_constants():
+    code = """
+        start EQU $10
+        count EQU start*2+1
+        LDA #count
+        STA start
+        HLT
+    """
+    assert assemble_lines(code.splitlines()) == [0x20, 0x21, 0x35, 0x10, 0xFF]
+
+def test_constant_expressions_use_labels():
+    code = """
+        LDA data+1
+        ADD #(end-data)/2
+        JMP ($FE - 1)
+    data:
+        BYTE #03 04
+    end:
+    """
+    assert assemble_lines(code.splitlines()) == [0x00, 0x07, 0x21, 0x01, 0x44, 0xFD, 0x03, 0x04]
+
+@pytest.mark.parametrize("name", ["True", "None", "for", "_s0"])
+def test_symbols_named_like_python_keywords(name):
+    code = ["NOP", "NOP", f"{name}:", f"LDA #{name}+1", f"{name}2 EQU {name}*2", f"ADD #{name}2"]
+    assert assemble_lines(code) == [0xFE, 0xFE, 0x20, 0x03, 0x21, 0x04]
+
+def test_constants_and_labels_share_a_namespace():
+    with pytest.raises(RuntimeError):
+        assemble_lines(["loop:", "loop EQU $01", "JMP loop"])
+
+@pytest.mark.parametrize("code", [
+    ["LDA #$FF+1"],
+    ["LDA #missing"],
+    ["LDA #$01/0"],
+    ["LDA #$01 +"],
+    ["late EQU early", "early EQU $01", "LDA #late"],
+    ])
+def test_bad_expressions_raise(code):
+    with pytest.raises(RuntimeError):
+        assemble_lines(code)
+
+countdown_macro = """
+    MACRO countdown from, step
+        LDA #from
+    loop\\@:
+        SUB #step
+        OTA
+        BNZ loop\\@
+    ENDM
+
+    countdown $03, 1
+    countdown $04, $02
+    HLT
+""".splitlines()
+
+def test_macros_expand_with_unique_labels(silent_computer):
+    expected = """
+        LDA #$03
+    loop_1:
+        SUB #1
+        OTA
+        BNZ loop_1
+        LDA #$04
+    loop_2:
+        SUB #$02
+        OTA
+        BNZ loop_2
+        HLT
+    """
+    assert assemble_lines(countdown_macro) == assemble_lines(expected.splitlines())
+
+    outputs = []
+    cpu = silent_computer(assemble_lines(countdown_macro), outputs=outputs)
+    cpu.run(mode='instruction', max_instructions=100)
+    assert outputs == [2, 1, 0, 2, 0]
+
+def test_macros_use_other_macros():
+    code = """
+        MACRO increment address
+            LDA address
+            ADD #$01
+            STA address
+        ENDM
+        MACRO increment2 address
+            increment address
+            increment address+1
+        ENDM
+        increment2 $20
+    """
+    assert assemble_lines(code.splitlines()) == [0x00, 0x20, 0x21, 0x01, 0x35, 0x20, 0x00, 0x21, 0x21, 0x01, 0x35, 0x21]
+
+def test_macro_labels_never_match_source_labels():
+    code = """
+        JMP loop_1
+        MACRO wait
+        loop\\@:
+            JMP loop\\@
+        ENDM
+        wait
+    loop_1:
+        HLT
+    """
+    assert assemble_lines(code.splitlines()) == [0x34, 0x04, 0x34, 0x02, 0xFF]
+
+    with pytest.raises(RuntimeError):
+        assemble_lines(["loop@1:", "JMP loop@1"])
+    with pytest.raises(RuntimeError):
+        AssemblerSession(["loop@1:", "JMP loop@1"])
+
+@pytest.mark.parametrize("code", [
+    ["MACRO nop2", "NOP"],
+    ["ENDM"],
+    ["MACRO LDA", "ENDM"],
+    ["MACRO twice a", "NOP", "ENDM", "twice"],
+    ["MACRO forever", "forever", "ENDM", "forever"],
+    ])
+def test_bad_macros_raise(code):
+    with pytest.raises(RuntimeError):
+        assemble_lines(code)
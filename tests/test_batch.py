@@ -0,0 +1,52 @@
+import pytest # type: ignore
+
+from sapy.batch import BatchComputer
+
+@pytest.fixture
+def programs(countdown):
+    return [
+        countdown(3),
+        countdown(1),
+        countdown(7),
+        [0x20, 0x09, 0x35, 0x0A, 0x45, 0x0B, 0x03, 0x0A, 0xFF, 0x00, 0x00, 0x0C], # STA
+        [0x34, 0x04, 0xFE, 0xFE, 0x44, 0x07, 0xFE, 0x09, 0xFF, 0xFF], # JMP, JMP ()
+        [0x10, 0x02, 0x06, 0xFF, 0x00, 0x00, 0x26], # LDA ($02)
+        [0x00, 0x06, 0x01, 0x07, 0xF6, 0xFF, 0xA1, 0x22], # LDA, ADD
+        [0xF7, 0xF6, 0x03, 0x05, 0x13, 0x05, 0xFF, 0x33], # BAI, OTA, OUT
+        [0xFD, 0xFE, 0xAB, 0xFF], # DMA, NOP, non-existant opcode, HLT
+        ]
+
+def test_batch_matches_computers(programs, silent_computer):
+    batch = BatchComputer(len(programs))
+    batch.load_programs(programs)
+    batch.load_inputs([[0x42]] * len(programs))
+    results = batch.run()
+
+    for machine, program in enumerate(programs):
+        outputs = []
+        cpu = silent_computer(program, outputs=outputs)
+        result = cpu.run(mode='instruction')
+        assert results[machine] == result
+        assert batch.outputs[machine] == outputs
+        assert bytes(batch.ram[machine]) == bytes(cpu.ram.values)
+        assert batch.halted[machine] == cpu.pc.halted
+        for reg in ['pc', 'mar', 'reg_a', 'reg_b', 'reg_o', 'reg_c', 'reg_i']:
+            assert getattr(batch, reg)[machine] == getattr(cpu, reg).value
+
+def test_batch_budgets_are_per_machine(countdown):
+    batch = BatchComputer(2)
+    batch.load_programs([countdown(1), [0xFE] * 256])
+    results = batch.run(max_instructions=50)
+
+    assert results[0].halt_reason == 'halted'
+    assert results[0].instructions == 5
+    assert results[1].halt_reason == 'max_instructions'
+    assert results[1].instructions == 50
+    assert batch.pc[1] == 50
+
+def test_batch_raises_when_input_runs_out():
+    batch = BatchComputer(1)
+    batch.load_programs([[0xF7, 0xF7, 0xFF]])
+    batch.load_inputs([[0x01]])
+    with pytest.raises(RuntimeError):
+        batch.run()
@@ -0,0 +1,81 @@
+import pytest
+
+from sapy.cache import ResultCache, definitions_version
+from sapy.components import mnemonics, LDA
+from sapy import cache as cache_module
+from sapy.parallel import run_many, run_program
+
+echo = [0xF7, 0xF6, 0xFF] # BAI, OTA, HLT
+
+def test_cache_returns_stored_result(countdown_source):
+    cache = ResultCache()
+    result = cache.run(countdown_source)
+    assert result == run_program(countdown_source)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    assert cache.run(countdown_source) is result
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_cache_keys_on_ram_image_inputs_and_budgets():
+    cache = ResultCache()
+    assert cache.key(echo) == cache.key(echo + [0x00])
+    assert cache.key(echo, [0x01]) != cache.key(echo, [0x02])
+    assert cache.key(echo, [0x01]) != cache.key(echo, [0x01], max_instructions=1)
+
+    assert cache.run(echo, [0x01]).outputs == bytes([0x01])
+    assert cache.run(echo, [0x02]).outputs == bytes([0x02])
+    assert cache.misses == 2
+
+def test_cache_evicts_least_recently_used():
+    cache = ResultCache(maxsize=2)
+    for value in (0x01, 0x02, 0x01, 0x03):
+        cache.run(echo, [value])
+    assert len(cache) == 2
+    assert cache.misses == 3
+
+    cache.run(echo, [0x01])
+    cache.run(echo, [0x02])
+    assert cache.misses == 4
+
+def test_cache_directory_is_shared(tmp_path, countdown_source):
+    ResultCache(directory=tmp_path).run(countdown_source)
+    cache = ResultCache(directory=tmp_path)
+    assert cache.run(countdown_source) == run_program(countdown_source)
+    assert (cache.hits, cache.misses) == (1, 0)
+
+@pytest.mark.parametrize("damage", [lambda data: data[:len(data) // 2], lambda data: b'garbage'])
+def test_cache_treats_corrupt_entries_as_misses(tmp_path, damage, countdown_source):
+    ResultCache(directory=tmp_path).run(countdown_source)
+    path, = tmp_path.iterdir()
+    path.write_bytes(damage(path.read_bytes()))
+
+    cache = ResultCache(directory=tmp_path)
+    assert cache.run(countdown_source) == run_program(countdown_source)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert ResultCache(directory=tmp_path).run(countdown_source) == run_program(countdown_source)
+
+def test_cache_keys_on_result_format(monkeypatch):
+    cache = ResultCache()
+    key = cache.key(echo)
+    monkeypatch.setattr(cache_module, 'RESULT_FORMAT', cache_module.RESULT_FORMAT + 1)
+    assert cache.key(echo) != key
+
+def test_definitions_version_changes_with_mnemonics(tmp_path, countdown_source):
+    assert definitions_version() == definitions_version(list(mnemonics))
+    assert definitions_version() != definitions_version([m for m in mnemonics if m is not LDA])
+
+    ResultCache(directory=tmp_path).run(countdown_source)
+    cache = ResultCache(directory=tmp_path, version=definitions_version(mnemonics[1:]))
+    cache.run(countdown_source)
+    assert cache.misses == 1
+
+def test_run_many_uses_cache(countdown_source):
+    cache = ResultCache()
+    programs = [countdown_source, echo, countdown_source]
+    inputs = [(), (0x99,), ()]
+    results = run_many(programs, workers=1, inputs=inputs, cache=cache)
+    assert results == run_many(programs, workers=1, inputs=inputs)
+    assert cache.misses == 2
+
+    run_many(programs, workers=1, inputs=inputs, cache=cache)
+    assert cache.misses == 2
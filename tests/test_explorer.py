@@ -0,0 +1,79 @@
+from sapy.components import Computer
+from sapy.explorer import Explorer
+
+def test_explorer_follows_every_input():
+    program = [
+        0xF7,       # 0x00 BAI
+        0x22, 0x80, # 0x01 SUB #$80
+        0x38, 0x0A, # 0x03 BNZ $0A
+        0x20, 0x01, # 0x05 LDA #$01
+        0xF6,       # 0x07 OTA
+        0xFF,       # 0x08 HLT
+        0xFE,       # 0x09 NOP
+        0x20, 0x00, # 0x0A LDA #$00
+        0xF6,       # 0x0C OTA
+        0xFF,       # 0x0D HLT
+        ]
+    paths = Explorer(program).explore()
+
+    assert len(paths) == 0xFF + 1
+    assert all(p.halt_reason == 'halted' for p in paths)
+    outputs = {p.inputs: p.outputs for p in paths}
+    assert outputs[(0x80,)] == bytes([0x01])
+    assert outputs[(0x7F,)] == bytes([0x00])
+
+def test_explorer_deduplicates_states():
+    program = [
+        0xF7,       # 0x00 BAI
+        0x22, 0x05, # 0x01 SUB #$05
+        0x38, 0x00, # 0x03 BNZ $00
+        0xFF,       # 0x05 HLT
+        ]
+    explorer = Explorer(program)
+    paths = explorer.explore()
+
+    # every input after the first loop reaches the same states again,
+    # and reading $05 first reaches the branch in the state (0x00, 0x05) did
+    assert [p.inputs for p in paths if p.halt_reason == 'halted'] == [(0x00, 0x05)]
+    # reading the same value again repeats the state of the last loop
+    assert (0x00, 0x00) in [p.inputs for p in paths if p.halt_reason == 'non_terminating']
+    assert len(explorer.visited) == 4 * (0xFF + 1) # forks and branches of two loops
+    assert explorer.merged > 0
+
+def test_explorer_stops_at_instruction_budget():
+    program = [0xFE] * 0x10 + [0x34, 0x00] # NOPs, JMP $00
+    paths = Explorer(program, max_instructions=5).explore()
+    assert [p.halt_reason for p in paths] == ['max_instructions']
+
+def test_explorer_reports_loops():
+    program = [0x34, 0x00] # 0x00 JMP $00
+    paths = Explorer(program, max_instructions=10).explore()
+    assert [p.halt_reason for p in paths] == ['non_terminating']
+    assert paths[0].instructions == 2
+
+    program = [
+        0xF7,       # 0x00 BAI
+        0x22, 0x05, # 0x01 SUB #$05
+        0x38, 0x06, # 0x03 BNZ $06
+        0xFF,       # 0x05 HLT
+        0x34, 0x06, # 0x06 JMP $06
+        ]
+    explorer = Explorer(program)
+    paths = explorer.explore()
+    halt_reasons = {p.inputs: p.halt_reason for p in paths}
+    assert len(halt_reasons) == 0xFF + 1
+    assert halt_reasons.pop((0x05,)) == 'halted'
+    assert set(halt_reasons.values()) == {'non_terminating'}
+    assert explorer.merged == 0
+
+def test_explorer_survives_fingerprint_collisions(monkeypatch):
+    monkeypatch.setattr(Computer, 'fingerprint', lambda self: 0)
+    program = [
+        0xF7,       # 0x00 BAI
+        0xF6,       # 0x01 OTA
+        0x34, 0x04, # 0x02 JMP $04
+        0xFF,       # 0x04 HLT
+        ]
+    paths = Explorer(program, input_values=range(4)).explore()
+    assert [p.outputs for p in paths] == [bytes([value]) for value in range(4)]
+    assert all(p.halt_reason == 'halted' for p in paths)
@@ -0,0 +1,81 @@
+import pytest # type: ignore
+
+from sapy.jit import BlockCompiler, compile_block, MAX_BLOCK_INSTRUCTIONS
+
+def _assert_jit_matches(silent_computer, program, **budget):
+    """Run program in instruction and jit mode, returns the RunResult both agree on"""
+    cpu = silent_computer(program)
+    expected = cpu.run(mode='instruction', **budget)
+    snapshot = cpu.snapshot()
+
+    cpu = silent_computer(program)
+    assert cpu.run(mode='jit', **budget) == expected
+    assert cpu.snapshot() == snapshot
+    return expected
+
+programs = [
+    [0x20, 0xFF, 0x21, 0x02, 0x22, 0x01, 0x22, 0x01, 0xFF], # carry, then flags of a later SUB
+    [0x10, 0x02, 0x06, 0xFF, 0x00, 0x00, 0x26], # LDA ($02), HLT
+    [0x00, 0x06, 0x02, 0x07, 0xF6, 0xFF, 0x09, 0x0A], # LDA $06, SUB $07, OTA, HLT
+    [0x20, 0x09, 0x35, 0x0A, 0x45, 0x0B, 0x03, 0x0A, 0xFF, 0x00, 0x00, 0x0C], # STA
+    [0xFE] * 256, # wraps around until the budget runs out
+    ]
+
+@pytest.mark.parametrize("program", programs)
+def test_jit_matches_instruction_mode(silent_computer, program):
+    _assert_jit_matches(silent_computer, program, max_instructions=1000)
+
+def test_jit_matches_instruction_mode_on_countdown(silent_computer, countdown):
+    result = _assert_jit_matches(silent_computer, countdown(), max_instructions=1000)
+    assert result.halt_reason == 'halted'
+
+def test_block_stops_at_branch(countdown):
+    memory = bytes(countdown()).ljust(0xFF + 1, b'\x00')
+    block = compile_block(memory, 0x02)
+    assert block.instructions == 2 # SUB, then OTA ends the block
+    assert block.addresses == (0x02, 0x03, 0x04)
+    assert block.cycles == 5 + 3
+
+def test_block_length_is_limited():
+    block = compile_block(bytes([0xFE] * 256), 0x00)
+    assert block.instructions == MAX_BLOCK_INSTRUCTIONS
+    assert block.cycles == 3 * MAX_BLOCK_INSTRUCTIONS
+
+def test_jit_recompiles_self_modifying_code(silent_computer):
+    program = [
+        0x20, 0x01, # 0x00 LDA #$01
+        0x21, 0x01, # 0x02 ADD #$01 operand changed by STA
+        0x35, 0x03, # 0x04 STA $03
+        0x22, 0x09, # 0x06 SUB #$09
+        0x38, 0x00, # 0x08 BNZ $00
+        0xFF,       # 0x0A HLT
+        ]
+    expected = _assert_jit_matches(silent_computer, program, max_instructions=1000)
+    assert expected.halt_reason == 'halted'
+
+def test_jit_drops_blocks_when_memory_is_loaded(silent_computer):
+    cpu = silent_computer([0x20, 0x01, 0xF6, 0xFF]) # LDA #$01, OTA, HLT
+    cpu.run(mode='jit')
+    assert cpu.reg_a.value == 0x01
+
+    cpu.reset()
+    cpu.switches.load_program([0x20, 0x02, 0xF6, 0xFF])
+    cpu.run(mode='jit')
+    assert cpu.reg_a.value == 0x02
+
+def test_block_compiler_drops_only_blocks_written(silent_computer):
+    cpu = silent_computer([0x20, 0x01, 0xF6, 0x20, 0x02, 0xF6, 0xFF])
+    jit = BlockCompiler(cpu.ram)
+    jit.block(0x00)
+    jit.block(0x03)
+
+    cpu.ram.load([0x03], address=0x04)
+    assert set(jit.blocks) == {0x00}
+
+    jit.flush()
+    assert not any(cpu.ram._watchers)
+
+@pytest.mark.parametrize("budget", [{'max_instructions': 101}, {'max_cycles': 333}, {'max_cycles': 2}])
+def test_jit_stops_looping_blocks_at_budget(silent_computer, countdown, budget):
+    expected = _assert_jit_matches(silent_computer, countdown(0xFF), **budget)
+    assert expected.halt_reason != 'halted'
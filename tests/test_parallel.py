@@ -0,0 +1,28 @@
+import pytest # type: ignore
+
+from sapy.parallel import run_many, run_program
+
+def test_run_program_collects_outputs(countdown_source):
+    result = run_program(countdown_source)
+    assert result.outputs == bytes([0x02, 0x01, 0x00])
+    assert result.halt_reason == 'halted'
+    assert result.instructions == 1 + 3 * 3 + 1
+    assert len(result.ram) == 0xFF + 1
+    assert result.ram[:2] == bytes([0x20, 0x03])
+
+def test_run_program_reads_inputs():
+    program = [0xF7, 0xF6, 0xF7, 0xF6, 0xFF] # BAI, OTA, BAI, OTA, HLT
+    result = run_program(program, inputs=[0x12, 0x34])
+    assert result.outputs == bytes([0x12, 0x34])
+
+    with pytest.raises(RuntimeError):
+        run_program(program, inputs=[0x12])
+
+def test_run_many_matches_run_program(countdown_source):
+    programs = [countdown_source, [0xF7, 0xF6, 0xFF], [0xFE] * 256]
+    inputs = [(), (0x99,), ()]
+    results = run_many(programs, workers=2, inputs=inputs, max_instructions=100)
+
+    assert results == [run_program(p, i, max_instructions=100) for p, i in zip(programs, inputs)]
+    assert results[1].outputs == bytes([0x99])
+    assert results[2].halt_reason == 'max_instructions'
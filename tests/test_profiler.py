@@ -0,0 +1,45 @@
+import pytest # type: ignore
+
+from sapy.profiler import Profiler, describe_opcode, source_map
+
+@pytest.fixture
+def profile(silent_computer, countdown):
+    def profile(mode, compiled=False):
+        cpu = silent_computer(countdown(), compiled=compiled)
+        profiler = Profiler()
+        cpu.attach_profiler(profiler)
+        return profiler, cpu.run(mode=mode)
+    return profile
+
+@pytest.mark.parametrize("mode", ['microcode', 'instruction', 'jit'])
+def test_profiler_counts_instructions_and_t_states(profile, mode):
+    profiler, result = profile(mode)
+    assert profiler.instructions == result.instructions
+    assert profiler.t_states == result.cycles
+
+    by_address = profiler.by_address()
+    assert by_address[0x00] == (1, 4)
+    assert by_address[0x02] == (3, 3 * 5)
+    assert by_address[0x05] == (3, 3 * 4)
+    assert profiler.by_mnemonic()[('BNZ', 'absolute_branching')] == (3, 3 * 4)
+
+def test_profiler_modes_agree(profile):
+    assert profile('microcode')[0].counts == profile('instruction')[0].counts
+    assert profile('microcode', compiled=True)[0].counts == profile('instruction')[0].counts
+
+def test_describe_opcode():
+    assert describe_opcode(0x20) == ('LDA', 'immediate')
+    assert describe_opcode(0xAB) == ('NOP', 'implied')
+
+def test_source_map(countdown_source):
+    lines = source_map(countdown_source)
+    assert lines[0x00] == ('LDA #$03', '')
+    assert lines[0x02] == ('SUB #$01', 'loop')
+
+def test_profiler_report_maps_to_source(profile, countdown_source):
+    profiler, result = profile('instruction')
+    report = profiler.report(countdown_source, top=3)
+    hottest = report.splitlines()[1]
+    assert hottest.startswith('0x02  loop')
+    assert 'SUB #$01' in hottest
+    assert 'SUB       immediate' in report
@@ -1,7 +1,7 @@
 import pytest # type: ignore
 import numpy as np # type: ignore
 
-from sapy.components import Register, Clock, ProgramCounter, MemoryAddressRegister, RandomAccessMemory, SwitchBoard, DMAReader, RegisterA, RegisterB, RegisterOutput, ArithmeticUnit, RegisterInstruction, Computer, AddressingMode, Mnemonic, OpCode, generate_opcode_map
+from sapy.components import Register, Clock, CompiledClock, ProgramCounter, MemoryAddressRegister, RandomAccessMemory, SwitchBoard, DMAReader, RegisterA, RegisterB, RegisterOutput, ArithmeticUnit, RegisterInstruction, Computer, AddressingMode, Mnemonic, OpCode, generate_opcode_map, opcode_map, decode_table, PredecodeCache, encode_control, control_names, EP, LM, CP
 
 def test_program_counter_increments():
     pc = ProgramCounter()
@@ -541,6 +541,39 @@ def test_dma_reader():
     for orig, read in zip(program, dma.read_ram().flatten()):
         assert orig == read
 
+def test_dma_reader_returns_a_view_of_ram():
+    mar = MemoryAddressRegister()
+    ram = RandomAccessMemory(mar)
+    switches = SwitchBoard(ram, mar)
+    dma = DMAReader(ram, mar)
+
+    bitmap = dma.read_ram()
+    assert bitmap.shape == (0xF + 1, 0xF + 1)
+    assert bitmap.dtype == np.uint8
+
+    switches.load_program([0x00, 0x11, 0x22])
+    assert bitmap[0x0, 0x2] == 0x22
+
+def test_ram_reset_keeps_views_valid():
+    mar = MemoryAddressRegister()
+    ram = RandomAccessMemory(mar)
+    view = ram.array()
+
+    ram.load([0xAB, 0xCD], address=0xFE)
+    assert list(view[0xFE:]) == [0xAB, 0xCD]
+
+    ram.reset()
+    assert not view.any()
+    assert ram.values[0xFE] == 0x00
+
+def test_switches_reject_programs_larger_than_ram():
+    mar = MemoryAddressRegister()
+    ram = RandomAccessMemory(mar)
+    switches = SwitchBoard(ram, mar)
+
+    with pytest.raises(ValueError):
+        switches.load_program([0xFE] * 257)
+
 def test_dma_reader_handler():
     program = [1, 2, 3, 4, 5, 6]
 
@@ -651,3 +684,488 @@ def test_program_counter_wraps():
 
     for _ in range(957):
         cpu.step(debug=False)
+
+def test_compiled_computer_matches_computer():
+    program = [
+        0x00, 0x0B, # 0x00 LDA $0B
+        0x02, 0x0C, # 0x02 SUB $0C
+        0x35, 0x0D, # 0x04 STA $0D
+        0xF6,       # 0x06 OTA
+        0x38, 0x02, # 0x07 BNZ $02
+        0xFF,       # 0x09 HLT
+        0xFE,       # 0x0A NOP
+        0x03,       # 0x0B $03
+        0x01,       # 0x0C $01
+        ]
+    outputs = {False: [], True: []}
+    cpus = {}
+    for compiled in (False, True):
+        cpu = Computer(compiled=compiled)
+        cpu.reg_o.output_function = outputs[compiled].append
+        cpu.switches.load_program(program)
+        while not cpu.pc.halted:
+            cpu.step(instructionwise=True, debug=False)
+        cpus[compiled] = cpu
+
+    assert outputs[True] == outputs[False] == [0x02, 0x01, 0x00]
+    for reg in ['pc', 'mar', 'reg_a', 'reg_b', 'reg_o', 'reg_i']:
+        assert getattr(cpus[True], reg).value == getattr(cpus[False], reg).value
+    assert cpus[True].ram.values == cpus[False].ram.values
+
+def test_compiled_clock_fails_if_multi_data_accessed():
+    clock = CompiledClock()
+    reg_a = RegisterA()
+    pc = ProgramCounter()
+    clock.add_component(reg_a)
+    clock.add_component(pc)
+
+    with pytest.raises(RuntimeError):
+        clock.data_bus(('ea', 'ep'))
+
+def test_compiled_clock_falls_back_to_component_methods():
+    class SpyComponent():
+        def __init__(self):
+            self.latched = None
+
+        def reset(self):
+            pass
+
+        def data(self, con=[]):
+            if 'es' in con:
+                return 0x42
+
+        def clock(self, *, data=None, con=[]):
+            if 'ls' in con:
+                self.latched = data
+
+    clock = CompiledClock()
+    reg_a = RegisterA()
+    spy = SpyComponent()
+    clock.add_component(reg_a)
+    clock.add_component(spy)
+    clock.microcode = (('es', 'la'), ('ea', 'ls'))
+
+    clock.step(debug=False)
+    assert reg_a.value == 0x42
+    reg_a.value = 0x17
+    clock.step(debug=False)
+    assert spy.latched == 0x17
+
+def _machine_state(cpu):
+    registers = {reg: getattr(cpu, reg).value
+        for reg in ['pc', 'mar', 'reg_a', 'reg_b', 'reg_o', 'reg_c', 'reg_i']}
+    return registers, cpu.pc.halted, bytes(cpu.ram.values)
+
+@pytest.mark.parametrize("program", [
+    [0x20, 0x05, 0x21, 0x07, 0xFF], # LDA #$05, ADD #$07, HLT
+    [0x00, 0x06, 0x02, 0x07, 0xF6, 0xFF, 0x09, 0x0A], # LDA $06, SUB $07, OTA, HLT
+    [0x10, 0x02, 0x06, 0xFF, 0x00, 0x00, 0x26], # LDA ($02), HLT
+    [0x20, 0x09, 0x35, 0x0A, 0x45, 0x0B, 0x03, 0x0A, 0xFF, 0x00, 0x00, 0x0C], # STA
+    [0x20, 0x03, 0x22, 0x01, 0xF6, 0x38, 0x02, 0xFF], # countdown with BNZ
+    [0x34, 0x04, 0xFE, 0xFE, 0x44, 0x07, 0xFE, 0x09, 0xFF, 0xFF], # JMP, JMP ()
+    [0xF7, 0xF6, 0x03, 0x05, 0x13, 0x05, 0xFF, 0x33], # BAI, OTA, OUT
+    [0xFD, 0xFE, 0xAB, 0xFF], # DMA, NOP, non-existant opcode, HLT
+    ])
+def test_instruction_mode_matches_microcode_mode(program, silent_computer):
+    results = {}
+    for mode in ['microcode', 'instruction', 'jit']:
+        outputs = []
+        cpu = silent_computer(program, outputs=outputs)
+        result = cpu.run(mode=mode)
+        results[mode] = result, outputs, _machine_state(cpu)
+
+    assert results['microcode'] == results['instruction'] == results['jit']
+
+def test_instruction_mode_finishes_instruction_in_progress():
+    cpu = Computer()
+    cpu.switches.load_program([0x20, 0x05, 0x21, 0x07, 0xFF])
+    cpu.step(debug=False)
+    cpu.step(debug=False)
+    result = cpu.run(mode='instruction')
+    assert result.instructions == 3
+    assert result.cycles == 2 + 5 + 3
+    assert cpu.reg_a.value == 0x0C
+
+def test_run_rejects_unknown_mode():
+    cpu = Computer()
+    with pytest.raises(ValueError):
+        cpu.run(mode='quantum')
+
+@pytest.mark.parametrize("mode", ['microcode', 'instruction', 'jit'])
+def test_run_until_halted(mode):
+    cpu = Computer()
+    program = [
+        0x20, 0x03, # 0x00 LDA #$03
+        0x22, 0x01, # 0x02 SUB #$01
+        0x38, 0x02, # 0x04 BNZ $02
+        0xFF,       # 0x06 HLT
+        ]
+    cpu.switches.load_program(program)
+    result = cpu.run(mode=mode)
+    assert result.halt_reason == 'halted'
+    assert result.instructions == 1 + 3 * 2 + 1
+    assert result.cycles == 4 + 3 * (5 + 4) + 3
+    assert cpu.pc.value == 0x06
+
+@pytest.mark.parametrize("mode", ['microcode', 'instruction', 'jit'])
+def test_run_stops_at_instruction_budget(mode):
+    cpu = Computer()
+    cpu.switches.load_program([0xFE] * 256)
+    result = cpu.run(mode=mode, max_instructions=300)
+    assert result.halt_reason == 'max_instructions'
+    assert result.instructions == 300
+    assert result.cycles == 300 * 3
+    assert cpu.pc.value == 300 % 256
+
+@pytest.mark.parametrize("mode", ['microcode', 'instruction', 'jit'])
+def test_run_stops_at_cycle_budget(mode):
+    cpu = Computer()
+    cpu.switches.load_program([0xFE] * 256)
+    result = cpu.run(mode=mode, max_cycles=10)
+    assert result.halt_reason == 'max_cycles'
+    assert result.instructions == 4 # the fourth instruction started at T-state 9
+    assert result.cycles == 12
+
+def test_reset_clears_halt():
+    cpu = Computer()
+    cpu.switches.load_program([0xFF])
+    assert cpu.run().instructions == 1
+    cpu.reset()
+    assert not cpu.pc.halted
+    cpu.switches.load_program([0xFF])
+    assert cpu.run().instructions == 1
+
+@pytest.mark.parametrize("a,b,subtract,nz,zero,carry", [
+    (0x03, 0x04, False, True, False, False),
+    (0xFF, 0x01, False, False, True, True),
+    (0x04, 0x04, True, False, True, False),
+    (0x00, 0x01, True, True, False, True),
+    ])
+def test_arithmetic_unit_sets_flags(a, b, subtract, nz, zero, carry):
+    reg_a = RegisterA()
+    reg_a.value = a
+    reg_b = RegisterB()
+    reg_b.value = b
+    adder = ArithmeticUnit(reg_a, reg_b)
+    assert adder.nz and not adder.zero and not adder.carry
+
+    adder.data(['eu', 'su'] if subtract else ['eu'])
+    assert (adder.nz, adder.zero, adder.carry) == (nz, zero, carry)
+
+@pytest.mark.parametrize("mode", ['microcode', 'instruction', 'jit'])
+def test_computers_do_not_share_flags(mode):
+    branch = [
+        0x38, 0x04, # 0x00 BNZ $04
+        0xFF,       # 0x02 HLT
+        0xFE,       # 0x03 NOP
+        0xFF,       # 0x04 HLT
+        ]
+    zeroed = Computer()
+    zeroed.switches.load_program([0x20, 0x01, 0x22, 0x01] + [0xFE] * 4 + branch) # LDA, SUB
+    fresh = Computer()
+    fresh.switches.load_program(branch)
+
+    # interleave the two computers
+    zeroed.run(mode=mode, max_instructions=2)
+    assert not zeroed.adder.nz
+    fresh.run(mode=mode)
+    zeroed.run(mode=mode)
+
+    assert fresh.pc.value == 0x04 # branch taken
+    assert zeroed.pc.value == 0x0A # branch not taken
+
+def test_decode_table_matches_opcode_map():
+    assert len(decode_table) == 0xFF + 1
+    for opcode, op in opcode_map.items():
+        test_fxn, (microcode_false, microcode_true) = decode_table[opcode]
+        assert microcode_true == op.decode()
+        if test_fxn is None:
+            assert microcode_false == microcode_true
+
+def test_decode_table_splits_conditional_opcodes():
+    test_fxn, (microcode_false, microcode_true) = decode_table[0x38] # BNZ $
+    assert test_fxn is not None
+    assert microcode_false[-1] == encode_control(tuple())
+    assert microcode_true[-1] == encode_control(('er', 'lp'))
+
+def test_decode_non_existant_opcode_as_nop(capsys):
+    clock = Clock()
+    clock.decode(0xAB)
+    assert clock.microcode == opcode_map[0xFE].decode()
+    assert capsys.readouterr().out == ""
+
+def test_control_words_encode_to_bitmasks():
+    assert encode_control(['ep', 'lm', 'cp']) == EP | LM | CP
+    assert encode_control(EP | CP) == EP | CP
+    assert encode_control([]) == 0
+    assert control_names(EP | LM | CP) == ('ep', 'lm', 'cp')
+
+def test_components_accept_encoded_control_words():
+    pc = ProgramCounter()
+    pc.clock(con=CP)
+    assert pc.data(EP | LM) == 0x01
+    assert pc.data(LM) is None
+
+def test_snapshot_restores_into_another_computer(silent_computer, countdown):
+    cpu = silent_computer(countdown(0x05))
+    cpu.run(max_instructions=4)
+    for _ in range(3):
+        cpu.step(debug=False) # stop mid instruction
+    snap = cpu.snapshot()
+    assert isinstance(snap, bytes)
+    assert len(snap) < 0xFF + 1 + 32
+
+    other = silent_computer(countdown(0x05))
+    other.restore(snap)
+    assert other.snapshot() == snap
+
+    cpu.run()
+    other.run()
+    assert other.snapshot() == cpu.snapshot()
+    assert _machine_state(other) == _machine_state(cpu)
+
+def test_restore_rewinds_computer(silent_computer, countdown):
+    cpu = silent_computer(countdown(0x05))
+    cpu.run(max_instructions=3)
+    snap = cpu.snapshot()
+    state = _machine_state(cpu)
+    first = cpu.run()
+
+    cpu.restore(snap)
+    assert _machine_state(cpu) == state
+    assert not cpu.pc.halted
+    assert cpu.run() == first
+
+def test_restore_rejects_unknown_versions():
+    cpu = Computer()
+    snap = bytearray(cpu.snapshot())
+    snap[0] = 0xEE
+    with pytest.raises(ValueError):
+        cpu.restore(bytes(snap))
+
+@pytest.mark.parametrize("mode", ['microcode', 'instruction'])
+def test_run_detects_loops(mode):
+    cpu = Computer()
+    cpu.switches.load_program([
+        0x20, 0x03, # 0x00 LDA #$03
+        0x21, 0x01, # 0x02 ADD #$01
+        0x22, 0x01, # 0x04 SUB #$01
+        0x34, 0x02, # 0x06 JMP $02
+        ])
+    result = cpu.run(mode=mode, detect_loops=True)
+    assert result.halt_reason == 'non_terminating'
+    assert result.instructions == 3 + 3 # the state saved after 3 instructions repeats a loop of 3 later
+
+def test_run_detects_program_counter_wrapping_forever():
+    cpu = Computer()
+    cpu.switches.load_program([0xFE] * 256)
+    result = cpu.run(mode='instruction', detect_loops=True)
+    assert result.halt_reason == 'non_terminating'
+    assert result.instructions == 0xFF + 0x100 # the state saved after 255 instructions repeats a loop of 256 later
+
+def test_run_loop_detection_survives_fingerprint_collisions(monkeypatch):
+    monkeypatch.setattr(Computer, 'fingerprint', lambda self: 0)
+    cpu = Computer()
+    cpu.switches.load_program([
+        0x20, 0x03, # 0x00 LDA #$03
+        0x22, 0x01, # 0x02 SUB #$01
+        0x38, 0x02, # 0x04 BNZ $02
+        0xFF,       # 0x06 HLT
+        ])
+    result = cpu.run(mode='instruction', detect_loops=True)
+    assert result.halt_reason == 'halted'
+
+def test_run_loop_detection_uses_constant_memory(monkeypatch):
+    state_keys = []
+    original = Computer.state_key
+    monkeypatch.setattr(Computer, 'state_key', lambda self: state_keys.append(None) or original(self))
+    cpu = Computer()
+    cpu.switches.load_program([
+        0x20, 0x00, # 0x00 LDA #$00
+        0x22, 0x01, # 0x02 SUB #$01
+        0x38, 0x02, # 0x04 BNZ $02
+        0xFF,       # 0x06 HLT
+        ])
+    result = cpu.run(mode='instruction', detect_loops=True)
+    assert result.halt_reason == 'halted'
+    assert result.instructions == 1 + 2 * 0x100 + 1
+    # states are only kept after 1, 2, 4, ... instructions
+    assert len(state_keys) <= 12
+
+def test_run_loop_detection_allows_reading_input():
+    cpu = Computer()
+    inputs = iter([0x00, 0x00, 0x00, 0x01])
+    cpu.reg_c.input_function = lambda: next(inputs)
+    cpu.switches.load_program([
+        0xF7,       # 0x00 BAI
+        0x21, 0x00, # 0x01 ADD #$00
+        0x38, 0x07, # 0x03 BNZ $07
+        0x34, 0x00, # 0x05 JMP $00
+        0xFF,       # 0x07 HLT
+        ])
+    result = cpu.run(mode='instruction', detect_loops=True)
+    assert result.halt_reason == 'halted'
+    assert result.instructions == 4 * 4
+
+def test_ram_fingerprint_follows_writes():
+    mar = MemoryAddressRegister()
+    ram = RandomAccessMemory(mar)
+    empty = ram.fingerprint
+
+    mar.latch(0x10)
+    ram.write(0x42)
+    assert ram.fingerprint != empty
+    ram.load([0x01, 0x02], address=0xFE)
+    written = ram.fingerprint
+    ram.rehash()
+    assert ram.fingerprint == written
+
+    ram.load([0x00, 0x00], address=0xFE)
+    ram.write(0x00)
+    assert ram.fingerprint == empty
+    ram.load([0x42], address=0x10)
+    ram.reset()
+    assert ram.fingerprint == empty
+
+def test_ram_fingerprint_ignores_write_order():
+    first = RandomAccessMemory(MemoryAddressRegister())
+    first.load([0x01, 0x02, 0x03])
+    second = RandomAccessMemory(MemoryAddressRegister())
+    second.load([0x03], address=0x02)
+    second.load([0x01, 0x02])
+    assert first.fingerprint == second.fingerprint
+
+@pytest.mark.parametrize("mode", ['microcode', 'instruction'])
+def test_computer_fingerprint_ignores_cycles(mode, silent_computer, countdown):
+    cpu = silent_computer(countdown(0x05))
+    start = cpu.fingerprint()
+    snap = cpu.snapshot()
+    cpu.run(mode=mode, max_instructions=3)
+    assert cpu.fingerprint() != start
+
+    other = silent_computer(countdown(0x05))
+    other.run(mode=mode, max_instructions=3)
+    other.restore(snap)
+    assert other.fingerprint() == start
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_computer_fingerprint_tracks_stores(compiled):
+    cpu = Computer(compiled=compiled)
+    cpu.switches.load_program([
+        0x20, 0x07, # 0x00 LDA #$07
+        0x35, 0x10, # 0x02 STA $10
+        0xFF,       # 0x04 HLT
+        ])
+    before = cpu.ram.fingerprint
+    cpu.run()
+    assert cpu.ram.fingerprint != before
+    after = cpu.ram.fingerprint
+    cpu.ram.rehash()
+    assert cpu.ram.fingerprint == after
+
+def test_ram_watchers_see_writes_in_range():
+    mar = MemoryAddressRegister()
+    ram = RandomAccessMemory(mar)
+    seen = []
+    handle = ram.watch(0x10, 0x20, lambda address, value: seen.append((address, value)))
+
+    mar.latch(0x0F)
+    ram.write(0x01)
+    mar.latch(0x10)
+    ram.write(0x02)
+    ram.clock(data=0x03, con=['lr'])
+    assert seen == [(0x10, 0x02), (0x10, 0x03)]
+
+    seen.clear()
+    ram.load([0x04, 0x05, 0x00], address=0x1E) # 0x20 is not watched
+    ram.load([0x04], address=0x1E) # unchanged
+    assert seen == [(0x1E, 0x04), (0x1F, 0x05)]
+
+    seen.clear()
+    ram.reset()
+    assert seen == [(0x10, 0x00), (0x1E, 0x00), (0x1F, 0x00)]
+
+    seen.clear()
+    ram.unwatch(handle)
+    ram.write(0x06)
+    assert seen == []
+
+def test_ram_watchers_see_restore(silent_computer, countdown):
+    cpu = silent_computer(countdown(0x05))
+    snap = cpu.snapshot()
+    seen = []
+    cpu.ram.watch(0x00, 0x02, lambda address, value: seen.append((address, value)))
+    cpu.ram.load([0x21, 0x05])
+    cpu.restore(snap)
+    assert seen == [(0x00, 0x21), (0x00, 0x20)]
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_direct_fetch_matches_fetch_over_bus(compiled):
+    program = [0x20, 0x03, 0x22, 0x01, 0x38, 0x02, 0x35, 0x10, 0xFF] # countdown, STA, HLT
+    stepped = Computer(compiled=compiled)
+    stepped.switches.load_program(program)
+    while not stepped.pc.halted:
+        stepped.step(debug=False) # one T-state at a time, fetching over the bus
+    stepped.step(instructionwise=True, debug=False)
+
+    run = Computer(compiled=compiled)
+    run.switches.load_program(program)
+    run.run(mode='microcode')
+    assert run.snapshot() == stepped.snapshot()
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_direct_fetch_sees_self_modifying_code(compiled, silent_computer):
+    program = [
+        0x20, 0x03, # 0x00 LDA #$03
+        0x22, 0x01, # 0x02 SUB #$01
+        0x35, 0x01, # 0x04 STA $01, the operand of LDA
+        0xF6,       # 0x06 OTA
+        0x38, 0x00, # 0x07 BNZ $00
+        0xFF,       # 0x09 HLT
+        ]
+    outputs = []
+    cpu = silent_computer(program, compiled=compiled, outputs=outputs)
+    result = cpu.run(mode='microcode', max_cycles=1000)
+    assert result.halt_reason == 'halted'
+    assert outputs == [0x02, 0x01, 0x00]
+
+def test_predecode_cache_drops_entries_on_writes():
+    ram = RandomAccessMemory(MemoryAddressRegister())
+    ram.load([0x10, 0x00, 0x20]) # LDA ($00) addresses the byte after the operand
+    cache = PredecodeCache(ram)
+    entry = cache.entry(0x00)
+    assert (entry.opcode, entry.operand, entry.pc, entry.mar, entry.t_states) == (0x10, 0x00, 0x02, 0x20, 2 + 4)
+    assert cache.entry(0x00) is entry
+
+    ram.load([0x30], address=0x02)
+    assert cache.entry(0x00).mar == 0x30
+    ram.load([0x00], address=0x00) # LDA $00
+    assert (cache.entry(0x00).opcode, cache.entry(0x00).mar) == (0x00, 0x00)
+
+def test_predecode_cache_drops_entries_on_block_changes():
+    mar = MemoryAddressRegister()
+    ram = RandomAccessMemory(mar)
+    ram.load([0x20, 0x07]) # LDA #$07
+    cache = PredecodeCache(ram)
+    assert cache.entry(0x00).operand == 0x07
+    mar.value = 0x01
+    ram.write(0x08)
+    assert cache.entry(0x00).operand == 0x08
+
+    memory, fingerprint = bytes(ram.memory), ram.fingerprint
+    ram.reset()
+    assert cache.entry(0x00).opcode == 0x00
+    ram.restore(memory, fingerprint)
+    assert cache.entry(0x00).operand == 0x08
+
+def test_predecode_cache_leaves_block_changes_undiffed(silent_computer, countdown):
+    cpu = silent_computer(countdown())
+    cpu.run(mode='microcode')
+    assert any(cpu.ram._watchers)
+    assert cpu.ram._watching == 0
+
+def test_connect_fetch_unwatches_previous_cache(silent_computer, countdown):
+    cpu = silent_computer(countdown())
+    cpu.run(mode='microcode')
+    cpu._clock.connect_fetch(cpu.pc, cpu.mar, cpu.ram)
+    assert not any(cpu.ram._watchers)
@@ -0,0 +1,43 @@
+from sapy.components import Computer, EP, LM, CP, ER, LI, LA
+from sapy.trace import Tracer
+
+def test_tracer_records_t_states():
+    cpu = Computer()
+    cpu.switches.load_program([0x20, 0xAB, 0xFF]) # LDA #$AB, HLT
+    tracer = Tracer()
+    cpu.attach_tracer(tracer)
+    result = cpu.run()
+
+    records = tracer.records()
+    assert len(records) == result.cycles == 4 + 3
+    assert list(records['cycle']) == list(range(7))
+    assert list(records['t_state']) == [0, 1, 2, 3, 0, 1, 2]
+    assert records[0]['control_word'] == EP | LM | CP
+    assert records[1]['control_word'] == ER | LI
+    assert records[1]['bus'] == 0x20
+    assert records[3]['control_word'] == ER | LA
+    assert records[3]['bus'] == 0xAB
+    assert records[3]['opcode'] == 0x20
+    assert records[4]['pc'] == 0x02
+    assert records[-1]['bus'] == -1 # nothing on the bus for HLT
+
+def test_tracer_keeps_last_records():
+    cpu = Computer()
+    cpu.switches.load_program([0xFE] * 256)
+    tracer = Tracer(depth=10)
+    cpu.attach_tracer(tracer)
+    cpu.run(max_cycles=30)
+
+    records = tracer.records()
+    assert len(tracer) == 10
+    assert tracer.dropped == 20
+    assert list(records['cycle']) == list(range(20, 30))
+
+def test_detached_tracer_records_nothing():
+    cpu = Computer()
+    cpu.switches.load_program([0xFF])
+    tracer = Tracer()
+    cpu.attach_tracer(tracer)
+    cpu.attach_tracer(None)
+    cpu.run()
+    assert len(tracer) == 0